@@ -155,7 +155,8 @@ static gboolean
 print_position (GstValidateMonitor *monitor)
 {
   GstQuery *query;
-  gint64 position, duration;
+  gint64 position = -1, duration = -1;
+  gchar rate_str[G_ASCII_DTOSTR_BUF_SIZE];
   GstElement *pipeline = GST_ELEMENT (GST_VALIDATE_MONITOR_GET_OBJECT (monitor));
 
   gdouble rate = 1.0;
@@ -175,6 +176,10 @@ print_position (GstValidateMonitor *monitor)
       "<position: %" GST_TIME_FORMAT " duration: %" GST_TIME_FORMAT
       " speed: %f />\r", GST_TIME_ARGS (position), GST_TIME_ARGS (duration),
       rate);
+  gst_validate_progress_printf ("position %" G_GINT64_FORMAT " %"
+      G_GINT64_FORMAT " %s %" G_GINT64_FORMAT, position, duration,
+      g_ascii_dtostr (rate_str, sizeof (rate_str), rate),
+      g_get_monotonic_time () * GST_USECOND);
 
   return TRUE;
 }
@@ -197,6 +202,15 @@ _bus_handler (GstBus * bus, GstMessage * message, GstValidateBinMonitor *monitor
         "Got warning: %s -- Debug message: %s", err->message, debug);
     g_error_free (err);
     g_free (debug);
+  } else if (GST_MESSAGE_TYPE (message) == GST_MESSAGE_STATE_CHANGED &&
+      GST_MESSAGE_SRC (message) == GST_VALIDATE_MONITOR_GET_OBJECT (monitor)) {
+    GstState newstate;
+
+    /* Used by the launcher to measure the startup latency */
+    gst_message_parse_state_changed (message, NULL, &newstate, NULL);
+    gst_validate_progress_printf ("state %s %" G_GINT64_FORMAT,
+        gst_element_state_get_name (newstate),
+        g_get_monotonic_time () * GST_USECOND);
   }
 }
 
@@ -28,4 +28,8 @@ GST_DEBUG_CATEGORY_EXTERN (gstvalidate_debug);
 #define GST_CAT_DEFAULT gstvalidate_debug
 void init_scenarios (void);
 
+/* Version of the records written by gst_validate_progress_printf */
+#define GST_VALIDATE_PROGRESS_VERSION 3
+void gst_validate_progress_printf (const gchar * format, ...) G_GNUC_PRINTF (1, 2);
+
 #endif
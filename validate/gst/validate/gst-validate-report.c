@@ -43,6 +43,9 @@ static GstValidateDebugFlags _gst_validate_flags = 0;
 static GHashTable *_gst_validate_issues = NULL;
 
 static FILE *log_file;
+static FILE *progress_file = NULL;
+/* Records are written from the streaming threads too */
+G_LOCK_DEFINE_STATIC (progress_file);
 
 G_DEFINE_BOXED_TYPE (GstValidateReport, gst_validate_report,
     (GBoxedCopyFunc) gst_validate_report_ref,
@@ -269,6 +272,24 @@ gst_validate_report_init (void)
   } else {
     log_file = stdout;
   }
+
+  /* Machine readable progress records, used by gst-validate-launcher */
+  file_env = g_getenv ("GST_VALIDATE_PROGRESS_FILE");
+  if (progress_file == NULL && file_env != NULL && *file_env != '\0') {
+    progress_file = g_fopen (file_env, "w");
+    if (progress_file == NULL)
+      g_printerr ("Could not open progress file '%s' for writing: %s\n",
+          file_env, g_strerror (errno));
+    else {
+      gst_validate_progress_printf ("version %d",
+          GST_VALIDATE_PROGRESS_VERSION);
+      /* Lets the launcher map the monotonic timestamps of the records
+       * to its own wall clock, to measure the startup latency */
+      gst_validate_progress_printf ("clock %" G_GINT64_FORMAT " %"
+          G_GINT64_FORMAT, g_get_monotonic_time () * GST_USECOND,
+          g_get_real_time () * GST_USECOND);
+    }
+  }
 }
 
 GstValidateIssue *
@@ -419,6 +440,40 @@ gst_validate_printf_valist (gpointer source,
   g_string_free (string, TRUE);
 }
 
+/**
+ * gst_validate_progress_printf:
+ * @format: The format of the record to write
+ * @...: The parameters of @format
+ *
+ * Writes a single line record to the file set in the
+ * GST_VALIDATE_PROGRESS_FILE environment variable (if any). Each record
+ * is made of space separated fields, the first one being the record type
+ * (position, seek, eos, buffering...), times are expressed in nanoseconds.
+ * Wall clock timestamps, as used to measure latencies, come from
+ * g_get_monotonic_time(), the "clock" record written first relates them
+ * to g_get_real_time().
+ * Records can be written from any thread.
+ * Floating point values should be formatted with g_ascii_dtostr() so that
+ * the records do not depend on the locale.
+ */
+void
+gst_validate_progress_printf (const gchar * format, ...)
+{
+  va_list var_args;
+
+  if (progress_file == NULL)
+    return;
+
+  G_LOCK (progress_file);
+  va_start (var_args, format);
+  vfprintf (progress_file, format, var_args);
+  va_end (var_args);
+
+  fputc ('\n', progress_file);
+  fflush (progress_file);
+  G_UNLOCK (progress_file);
+}
+
 void
 gst_validate_report_printf (GstValidateReport * report)
 {
@@ -224,14 +224,22 @@ gst_validate_scenario_execute_seek (GstValidateScenario * scenario,
 {
   gboolean ret = TRUE;
   GstValidateScenarioPrivate *priv = scenario->priv;
+  gchar rate_str[G_ASCII_DTOSTR_BUF_SIZE];
+  GstClockTime seek_time;
 
   GstEvent *seek = gst_event_new_seek (rate, format, flags, start_type, start,
       stop_type, stop);
 
   gst_event_ref (seek);
+  seek_time = g_get_monotonic_time () * GST_USECOND;
   if (gst_element_send_event (scenario->pipeline, seek)) {
     gst_event_replace (&priv->last_seek, seek);
     priv->seek_flags = flags;
+    /* The time at which the seek was sent lets the launcher measure how
+     * long it takes to complete, see the seek-done record */
+    gst_validate_progress_printf ("seek %" G_GUINT64_FORMAT " %"
+        G_GUINT64_FORMAT " %s %" G_GUINT64_FORMAT, start, stop,
+        g_ascii_dtostr (rate_str, sizeof (rate_str), rate), seek_time);
   } else {
     GST_VALIDATE_REPORT (scenario, EVENT_SEEK_NOT_HANDLED,
         "Could not execute seek: '(position %" GST_TIME_FORMAT
@@ -397,6 +405,8 @@ _execute_eos (GstValidateScenario * scenario, GstValidateAction * action)
 {
   gst_validate_printf (action, "sending EOS at %" GST_TIME_FORMAT "\n",
       GST_TIME_ARGS (action->playback_time));
+  gst_validate_progress_printf ("eos %" G_GUINT64_FORMAT,
+      action->playback_time);
 
   GST_DEBUG ("Sending eos to pipeline at %" GST_TIME_FORMAT,
       GST_TIME_ARGS (action->playback_time));
@@ -847,6 +857,8 @@ message_cb (GstBus * bus, GstMessage * message, GstValidateScenario * scenario)
   switch (GST_MESSAGE_TYPE (message)) {
     case GST_MESSAGE_ASYNC_DONE:
       if (priv->last_seek) {
+        gst_validate_progress_printf ("seek-done %" G_GUINT64_FORMAT,
+            (guint64) g_get_monotonic_time () * GST_USECOND);
         gst_validate_scenario_update_segment_from_seek (scenario,
             priv->last_seek);
         gst_event_replace (&priv->last_seek, NULL);
@@ -934,6 +946,7 @@ message_cb (GstBus * bus, GstMessage * message, GstValidateScenario * scenario)
         priv->buffering = TRUE;
 
       g_print ("%s %d%%  \r", "Buffering...", percent);
+      gst_validate_progress_printf ("buffering %d", percent);
       break;
     }
     default:
@@ -22,28 +22,245 @@
 
 This module builds on BaseHTTPServer by implementing the standard GET
 and HEAD requests in a fairly straightforward manner, and includes support
-for the Range header.
+for the Range header (including multiple ranges).
+
+Each connection is handled in its own thread, connections are kept alive
+(HTTP/1.1) and files are sent with sendfile(2) when it is available.
+
+Network conditions can be emulated by prefixing the path of the requests
+with /network-profile/NAME/, NAME being one of the NETWORK_PROFILES.
+
+Requests whose path is prefixed with /test/TAG/ are recorded, and the records
+of a TAG can be retrieved (once) as JSON from /traffic-stats/TAG.
 
 """
 
 
-__version__ = "0.1"
+__version__ = "0.2"
 
-__all__ = ["RangeHTTPRequestHandler"]
+__all__ = ["RangeHTTPRequestHandler", "ThreadingHTTPServer",
+           "NetworkProfile", "NETWORK_PROFILES", "get_network_profile_uri",
+           "get_traffic_tag_uri", "get_traffic_stats_uri"]
 
 import os
+import sys
+import json
+import time
+import errno
+import random
+import urlparse
+import itertools
+import threading
+import ctypes
 import posixpath
 import BaseHTTPServer
+import SocketServer
 import urllib
 import cgi
 import shutil
 import mimetypes
+import mimetools
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
 
+CHUNK_SIZE = 64 * 1024
+
+
+def _get_libc_sendfile():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+
+    def libc_sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+
+    return libc_sendfile
+
+if hasattr(os, "sendfile"):
+    sendfile = os.sendfile
+else:
+    sendfile = _get_libc_sendfile()
+
+
+class NetworkProfile(object):
+
+    """Network conditions to emulate when serving a file.
+
+    bandwidth: Maximum number of bytes per second, 0 for no limit
+    latency: Seconds to wait before answering a request
+    jitter: Maximum random delay, in seconds, added before sending each chunk
+    stall_period, stall_duration: Stop sending data for stall_duration
+        seconds every stall_period seconds
+    drop_after: Number of bytes of a response after which the connection
+        is dropped, 0 to never drop it
+
+    """
+
+    def __init__(self, bandwidth=0, latency=0, jitter=0, stall_period=0,
+                 stall_duration=0, drop_after=0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.jitter = jitter
+        self.stall_period = stall_period
+        self.stall_duration = stall_duration
+        self.drop_after = drop_after
+
+
+NETWORK_PROFILE_PREFIX = "network-profile"
+NETWORK_PROFILES = {
+    "regular_3g": NetworkProfile(bandwidth=750000 / 8, latency=0.1),
+    "good_3g": NetworkProfile(bandwidth=1500000 / 8, latency=0.04),
+    "regular_4g": NetworkProfile(bandwidth=4000000 / 8, latency=0.02),
+    "dsl": NetworkProfile(bandwidth=2000000 / 8, latency=0.005),
+    "jittery_wifi": NetworkProfile(bandwidth=10000000 / 8, latency=0.01,
+                                   jitter=0.05),
+    "stalling": NetworkProfile(bandwidth=4000000 / 8, latency=0.02,
+                               stall_period=10, stall_duration=2),
+    "dropping": NetworkProfile(bandwidth=4000000 / 8, latency=0.02,
+                               drop_after=1024 * 1024),
+}
+
+
+def get_network_profile_uri(uri, name):
+    """Return the uri to get uri under the network profile called name."""
+    parsed = urlparse.urlparse(uri)
+    return urlparse.urlunparse(parsed._replace(
+        path="/%s/%s%s" % (NETWORK_PROFILE_PREFIX, name, parsed.path)))
+
+
+TRAFFIC_TAG_PREFIX = "test"
+TRAFFIC_STATS_PREFIX = "traffic-stats"
+
+
+def get_traffic_tag_uri(uri, tag):
+    """Return the uri to get uri with its requests recorded under tag."""
+    parsed = urlparse.urlparse(uri)
+    return urlparse.urlunparse(parsed._replace(
+        path="/%s/%s%s" % (TRAFFIC_TAG_PREFIX, urllib.quote(tag, safe=""),
+                           parsed.path)))
+
+
+def get_traffic_stats_uri(host, port, tag):
+    """Return the uri from which to get the records of the requests made
+    with tag."""
+    return "http://%s:%s/%s/%s" % (host, port, TRAFFIC_STATS_PREFIX,
+                                   urllib.quote(tag, safe=""))
+
+
+class ConnectionDropped(Exception):
+    pass
+
+
+class _Throttle(object):
+
+    """Paces the data sent for a response according to a NetworkProfile.
+
+    Bandwidth is limited with a token bucket allowing bursts of 100ms of
+    data. Jitter comes from a random generator seeded with seed so that
+    runs are reproducible.
+
+    """
+
+    def __init__(self, profile, seed):
+        self._profile = profile
+        self._random = random.Random(seed)
+        self._start = self._last = time.time()
+        self._burst = max(profile.bandwidth / 10, 1024)
+        self._tokens = self._burst
+        self._sent = 0
+
+    def wait(self, size):
+        """Wait until data can be sent.
+
+        Return value is the number of bytes (at most size) which can be sent
+        right away. Raises ConnectionDropped when the connection should be
+        dropped.
+
+        """
+        profile = self._profile
+        size = min(size, CHUNK_SIZE)
+        if profile.drop_after:
+            if self._sent >= profile.drop_after:
+                raise ConnectionDropped()
+            size = min(size, profile.drop_after - self._sent)
+
+        if profile.stall_period:
+            position = (time.time() - self._start) % profile.stall_period
+            if position >= profile.stall_period - profile.stall_duration:
+                time.sleep(profile.stall_period - position)
+
+        if profile.jitter:
+            time.sleep(self._random.uniform(0, profile.jitter))
+
+        if profile.bandwidth:
+            size = min(size, self._burst)
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._last) * profile.bandwidth)
+            self._last = now
+            if self._tokens < size:
+                time.sleep((size - self._tokens) / float(profile.bandwidth))
+                now = time.time()
+                self._tokens += (now - self._last) * profile.bandwidth
+                self._last = now
+            self._tokens -= size
+
+        self._sent += size
+        return size
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """HTTP server handling each connection in a separate thread.
+
+    Files are served from the directory attribute, or the current directory
+    if it is None, and the access log is written to the logfile attribute,
+    or stderr if it is None.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+    directory = None
+    logfile = None
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self._traffic = {}
+        self._traffic_lock = threading.Lock()
+        self._connection_ids = itertools.count()
+
+    def new_connection_id(self):
+        return next(self._connection_ids)
+
+    def add_request(self, tag, record):
+        """Record a request made with tag."""
+        with self._traffic_lock:
+            self._traffic.setdefault(tag, []).append(record)
+
+    def pop_requests(self, tag):
+        """Return and forget the records of the requests made with tag."""
+        with self._traffic_lock:
+            return self._traffic.pop(tag, [])
+
+
 class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     """Simple HTTP request handler with GET and HEAD commands.
@@ -58,52 +275,188 @@ class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """
 
     server_version = "RangeHTTP/" + __version__
+    protocol_version = "HTTP/1.1"
+    # Headers and data are sent separately, do not wait for the client to
+    # acknowledge the headers before sending small responses
+    disable_nagle_algorithm = True
+
+    network_profile = None
+    traffic = None
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection_id = self.server.new_connection_id()
 
     def do_GET(self):
         """Serve a GET request."""
-        f, start_range, end_range = self.send_head()
-        print "Got values of ", start_range, " and ", end_range, "...\n"
+        f, ranges = self.send_head()
         if f:
-            f.seek(start_range, 0)
-            chunk = 0x1000
-            total = 0
-            while chunk > 0:
-                if start_range + chunk > end_range:
-                    chunk = end_range - start_range
-                try:
-                    self.wfile.write(f.read(chunk))
-                except:
-                    break
-                total += chunk
-                start_range += chunk
-            f.close()
+            throttle = None
+            if self.network_profile:
+                throttle = _Throttle(self.network_profile,
+                                     self.path + self.headers.get("Range", ""))
+            try:
+                for (part_header, start_range, end_range) in ranges:
+                    self.wfile.write(part_header)
+                    self.send_range(f, start_range, end_range, throttle)
+            except ConnectionDropped:
+                self.log_message("Dropped connection while sending %s",
+                                 self.path)
+                self.close_connection = 1
+            except (IOError, OSError) as e:
+                # The client went away
+                self.log_error("Could not send %s: %s", self.path, e)
+                self.close_connection = 1
+            finally:
+                f.close()
+        self.traffic = None
 
     def do_HEAD(self):
         """Serve a HEAD request."""
-        f, start_range, end_range = self.send_head()
+        f, ranges = self.send_head()
         if f:
             f.close()
+        self.traffic = None
+
+    def send_range(self, f, start_range, end_range, throttle=None):
+        """Send the bytes from start_range to end_range (excluded) of f,
+        paced by throttle if not None."""
+        if throttle is None:
+            self.send_bytes(f, start_range, end_range)
+            return
+
+        while start_range < end_range:
+            size = throttle.wait(end_range - start_range)
+            self.send_bytes(f, start_range, start_range + size)
+            start_range += size
+
+    def send_bytes(self, f, start_range, end_range):
+        try:
+            fileno = f.fileno()
+        except AttributeError:
+            fileno = None
+
+        if fileno is None or sendfile is None:
+            f.seek(start_range, 0)
+            while start_range < end_range:
+                chunk = f.read(min(CHUNK_SIZE, end_range - start_range))
+                if not chunk:
+                    raise IOError("%s is shorter than expected" % f.name)
+                self.wfile.write(chunk)
+                start_range += len(chunk)
+                if self.traffic:
+                    self.traffic["bytes"] += len(chunk)
+            return
+
+        self.wfile.flush()
+        while start_range < end_range:
+            try:
+                sent = sendfile(self.connection.fileno(), fileno, start_range,
+                                end_range - start_range)
+            except OSError as e:
+                if e.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            if sent == 0:
+                raise IOError("%s is shorter than expected" % f.name)
+            start_range += sent
+            if self.traffic:
+                self.traffic["bytes"] += sent
+
+    def parse_ranges(self, size):
+        """Parse the Range header.
+
+        Return value is a list of (start, end) tuples, end being excluded,
+        an empty list if none of the ranges can be satisfied, or None if
+        the whole file should be sent.
+
+        """
+        header = self.headers.get("Range", "").strip()
+        if not header.startswith("bytes="):
+            return None
+
+        ranges = []
+        for spec in header[len("bytes="):].split(","):
+            s, sep, e = spec.strip().partition("-")
+            try:
+                if not sep:
+                    return None
+                elif s:
+                    start_range = int(s)
+                    end_range = size
+                    if e:
+                        end_range = int(e) + 1
+                        if end_range <= start_range:
+                            return None
+                elif e:
+                    start_range = max(size - int(e), 0)
+                    end_range = size
+                else:
+                    return None
+            except ValueError:
+                # Invalid ranges are ignored
+                return None
+
+            if start_range < size:
+                ranges.append((start_range, min(end_range, size)))
+
+        return ranges
 
     def send_head(self):
         """Common code for GET and HEAD commands.
 
         This sends the response code and MIME headers.
 
-        Return value is either a file object (which has to be copied
-        to the outputfile by the caller unless the command was HEAD,
-        and must be closed by the caller under all circumstances), or
-        None, in which case the caller has nothing further to do.
+        Return value is a (file object, ranges) tuple. The file object
+        has to be copied to the outputfile by the caller unless the
+        command was HEAD, and must be closed by the caller under all
+        circumstances, or is None, in which case the caller has nothing
+        further to do. ranges is a list of (part header, start, end)
+        tuples, describing what to send.
 
         """
-        path = self.translate_path(self.path)
+        path = self.path
+        self.network_profile = None
+        self.traffic = None
+        profile_name = None
+        while True:
+            words = path.split('/', 3)
+            if len(words) < 3:
+                break
+            elif words[1] == TRAFFIC_STATS_PREFIX and path == self.path:
+                return self.send_traffic_stats(urllib.unquote(words[2]))
+            elif words[1] == TRAFFIC_TAG_PREFIX:
+                self.traffic = {"path": "/" + (words[3] if len(words) > 3 else ""),
+                                "range": self.headers.get("Range"),
+                                "connection": self.connection_id,
+                                "time": time.time(),
+                                "status": None,
+                                "ttfb": None,
+                                "bytes": 0}
+                self.server.add_request(urllib.unquote(words[2]), self.traffic)
+            elif words[1] == NETWORK_PROFILE_PREFIX:
+                profile_name = words[2]
+            else:
+                break
+            path = "/" + (words[3] if len(words) > 3 else "")
+
+        if profile_name is not None:
+            if profile_name not in NETWORK_PROFILES:
+                self.send_error(404, "Unknown network profile")
+                return (None, [])
+            self.network_profile = NETWORK_PROFILES[profile_name]
+            time.sleep(self.network_profile.latency)
+
+        path = self.translate_path(path)
         f = None
         if os.path.isdir(path):
             if not self.path.endswith('/'):
                 # redirect browser - doing basically what apache does
                 self.send_response(301)
                 self.send_header("Location", self.path + "/")
+                self.send_header("Content-Length", "0")
                 self.end_headers()
-                return (None, 0, 0)
+                return (None, [])
             for index in "index.html", "index.htm":
                 index = os.path.join(path, index)
                 if os.path.exists(index):
@@ -119,35 +472,81 @@ class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             f = open(path, 'rb')
         except IOError:
             self.send_error(404, "File not found")
-            return (None, 0, 0)
-        if "Range" in self.headers:
-            self.send_response(206)
-        else:
-            self.send_response(200)
-        self.send_header("Content-type", ctype)
+            return (None, [])
         fs = os.fstat(f.fileno())
         size = int(fs[6])
-        start_range = 0
-        end_range = size
+        ranges = self.parse_ranges(size)
+        if ranges == []:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return (None, [])
+
+        if ranges is None:
+            self.send_response(200)
+            self.send_header("Content-type", ctype)
+            ranges = [("", 0, size)]
+            length = size
+        elif len(ranges) == 1:
+            start_range, end_range = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Range", "bytes %d-%d/%d"
+                             % (start_range, end_range - 1, size))
+            ranges = [("", start_range, end_range)]
+            length = end_range - start_range
+        else:
+            boundary = mimetools.choose_boundary()
+            self.send_response(206)
+            self.send_header("Content-type",
+                             "multipart/byteranges; boundary=%s" % boundary)
+            ranges = [("\r\n--%s\r\n"
+                       "Content-type: %s\r\n"
+                       "Content-Range: bytes %d-%d/%d\r\n\r\n"
+                       % (boundary, ctype, start_range, end_range - 1, size),
+                       start_range, end_range)
+                      for start_range, end_range in ranges]
+            ranges.append(("\r\n--%s--\r\n" % boundary, 0, 0))
+            length = sum(len(part_header) + end_range - start_range
+                         for part_header, start_range, end_range in ranges)
+
         self.send_header("Accept-Ranges", "bytes")
-        if "Range" in self.headers:
-            s, e = self.headers['range'][6:].split('-', 1)
-            sl = len(s)
-            el = len(e)
-            if sl > 0:
-                start_range = int(s)
-                if el > 0:
-                    end_range = int(e) + 1
-            elif el > 0:
-                ei = int(e)
-                if ei < size:
-                    start_range = size - ei
-        self.send_header("Content-Range", 'bytes ' + str(start_range) + '-' + str(end_range - 1) + '/' + str(size))
-        self.send_header("Content-Length", end_range - start_range)
+        self.send_header("Content-Length", str(length))
         self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
         self.end_headers()
-        print "Sending Bytes ",start_range, " to ", end_range, "...\n"
-        return (f, start_range, end_range)
+        return (f, ranges)
+
+    def send_traffic_stats(self, tag):
+        """Send the records of the requests made with tag as JSON."""
+        data = StringIO(json.dumps(self.server.pop_requests(tag)))
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(data.getvalue())))
+        self.end_headers()
+        return (data, [("", 0, len(data.getvalue()))])
+
+    def send_response(self, code, message=None):
+        if self.traffic:
+            self.traffic["status"] = code
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def end_headers(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+        if self.traffic:
+            self.traffic["ttfb"] = time.time() - self.traffic["time"]
+
+    def address_string(self):
+        """Do not resolve the client host name in the access log."""
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        logfile = getattr(self.server, "logfile", None) or sys.stderr
+        logfile.write("%s - - [%s] %s\n" % (self.address_string(),
+                                            self.log_date_time_string(),
+                                            format % args))
+        logfile.flush()
 
     def list_directory(self, path):
         """Helper to produce a directory listing (absent index.html).
@@ -161,7 +560,7 @@ class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             list = os.listdir(path)
         except os.error:
             self.send_error(404, "No permission to list directory")
-            return None
+            return (None, [])
         list.sort(key=lambda a: a.lower())
         f = StringIO()
         displaypath = cgi.escape(urllib.unquote(self.path))
@@ -188,7 +587,7 @@ class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.send_header("Content-type", "text/html")
         self.send_header("Content-Length", str(length))
         self.end_headers()
-        return (f, 0, length)
+        return (f, [("", 0, length)])
 
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax.
@@ -204,7 +603,7 @@ class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         path = posixpath.normpath(urllib.unquote(path))
         words = path.split('/')
         words = filter(None, words)
-        path = os.getcwd()
+        path = getattr(self.server, "directory", None) or os.getcwd()
         for word in words:
             drive, word = os.path.splitdrive(word)
             head, word = os.path.split(word)
@@ -266,8 +665,8 @@ class RangeHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 
 def test(HandlerClass = RangeHTTPRequestHandler,
-         ServerClass = BaseHTTPServer.HTTPServer):
-    BaseHTTPServer.test(HandlerClass, ServerClass)
+         ServerClass = ThreadingHTTPServer):
+    BaseHTTPServer.test(HandlerClass, ServerClass, protocol="HTTP/1.1")
 
 
 if __name__ == '__main__':
@@ -100,6 +100,10 @@ class GESTest(GstValidateTest):
         self.set_sample_paths()
         self.add_arguments("-l", self.project_uri)
 
+    def get_input_files(self):
+        return GstValidateTest.get_input_files(self) + \
+            [utils.url2path(self.project_uri)]
+
 
 class GESPlaybackTest(GESTest):
     def __init__(self, classname, options, reporter, project_uri, scenario):
@@ -247,9 +251,10 @@ Available options:""")
             for comb in GES_ENCODING_TARGET_COMBINATIONS:
                 classname = "ges.render.%s.%s" % (str(comb).replace(' ', '_'),
                                                   os.path.splitext(os.path.basename(proj))[0])
-                self.add_test(GESRenderTest(classname, self.options,
-                                            self.reporter, proj,
-                                            combination=comb)
-                                  )
+                test = GESRenderTest(classname, self.options,
+                                     self.reporter, proj,
+                                     combination=comb)
+                test.benchmark_group = (os.path.basename(proj), str(comb))
+                self.add_test(test)
 
         return self.tests
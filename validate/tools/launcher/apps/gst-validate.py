@@ -17,27 +17,63 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 import os
+import json
 import time
+import sqlite3
 import urlparse
 import subprocess
 import ConfigParser
 import xml.etree.ElementTree as ET
 from loggable import Loggable
+from multiprocessing.pool import ThreadPool
+from RangeHTTPServer import get_network_profile_uri, get_traffic_tag_uri
 
 from baseclasses import GstValidateTest, TestsManager, Test, ScenarioManager, NamedDic
 from utils import MediaFormatCombination, get_profile,\
     path2url, DEFAULT_TIMEOUT, which, GST_SECOND, Result, \
-    compare_rendered_with_original, Protocols
+    compare_rendered_with_original, Protocols, printc, Colors, \
+    DEFAULT_HTTP_SERVER_PORT
 
 class MediaDescriptor(Loggable):
-    def __init__(self, xml_path):
+    def __init__(self, xml_path, infos=None):
+        """
+        @infos: The informations previously extracted from @xml_path (as
+                returned by get_infos), if None @xml_path is parsed
+        """
         Loggable.__init__(self)
         self._xml_path = xml_path
-        self.media_xml = ET.parse(xml_path).getroot()
-
-        # Sanity checks
-        self.media_xml.attrib["duration"]
-        self.media_xml.attrib["seekable"]
+        if infos is None:
+            infos = self._parse_infos(xml_path)
+        self._infos = infos
+
+    def _parse_infos(self, xml_path):
+        media_xml = ET.parse(xml_path).getroot()
+        streams = media_xml.findall("streams")[0]
+
+        tracks = {}
+        for stream in streams.findall("stream"):
+            tracks[stream.attrib["type"]] = tracks.get(stream.attrib["type"], 0) + 1
+
+        return {"uri": media_xml.attrib["uri"],
+                "duration": long(media_xml.attrib["duration"]),
+                "seekable": media_xml.attrib["seekable"],
+                "caps": streams.attrib["caps"],
+                "protocol": media_xml.attrib.get("protocol"),
+                "tracks": tracks}
+
+    def get_infos(self):
+        return self._infos
+
+    def get_files(self):
+        """
+        Returns: The paths of the descriptor and of the media file it
+                 describes when it is a local one
+        """
+        files = [self._xml_path]
+        if self._xml_path.endswith("." + G_V_MEDIA_INFO_EXT):
+            files.append(self._xml_path[:-len("." + G_V_MEDIA_INFO_EXT)])
+
+        return files
 
     def get_media_filepath(self):
         if self.get_protocol() == Protocols.FILE:
@@ -47,36 +83,31 @@ class MediaDescriptor(Loggable):
 
 
     def get_caps(self):
-        return self.media_xml.findall("streams")[0].attrib["caps"]
+        return self._infos["caps"]
 
     def get_uri(self):
-        return self.media_xml.attrib["uri"]
+        return self._infos["uri"]
+
+    def set_uri(self, uri):
+        self._infos["uri"] = uri
 
     def get_duration(self):
-        return long(self.media_xml.attrib["duration"])
+        return self._infos["duration"]
 
     def set_protocol(self, protocol):
-        self.media_xml.attrib["protocol"] = protocol
+        self._infos["protocol"] = protocol
 
     def get_protocol(self):
-        return self.media_xml.attrib["protocol"]
+        return self._infos["protocol"]
 
     def is_seekable(self):
-        return self.media_xml.attrib["seekable"]
+        return self._infos["seekable"]
 
     def is_image(self):
-        for stream in self.media_xml.findall("streams")[0].findall("stream"):
-            if stream.attrib["type"] == "image":
-                return True
-        return False
+        return self.get_num_tracks("image") > 0
 
     def get_num_tracks(self, track_type):
-        n = 0
-        for stream in self.media_xml.findall("streams")[0].findall("stream"):
-            if stream.attrib["type"] == track_type:
-                n += 1
-
-        return n
+        return self._infos["tracks"].get(track_type, 0)
 
     def is_compatible(self, scenario):
         if scenario.seeks() and (not self.is_seekable() or self.is_image()):
@@ -94,6 +125,76 @@ class MediaDescriptor(Loggable):
 
         return True
 
+class MediaDescriptorsIndex(Loggable):
+    """
+    On disk index of the informations extracted from media descriptor
+    files (.media_info and .stream_info), so that they do not need to be
+    parsed again as long as they did not change.
+
+    Entries are keyed on the descriptor path, size and modification time,
+    and on the modification time of its directory, which changes when
+    media specific scenarios are added or removed.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        Loggable.__init__(self)
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=30)
+        # Paths are not necessarily valid unicode, keep them as is
+        self._db.text_factory = str
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self.debug("Creating media descriptors index in %s", path)
+            self._db.execute("DROP TABLE IF EXISTS media_descriptors")
+            self._db.execute("CREATE TABLE media_descriptors ("
+                             " path TEXT PRIMARY KEY, size INTEGER, mtime REAL,"
+                             " dir_mtime REAL, uri TEXT, protocol TEXT,"
+                             " duration TEXT, seekable TEXT, caps TEXT,"
+                             " tracks TEXT, special_scenarios TEXT)")
+            self._db.execute("PRAGMA user_version = %d" % self.VERSION)
+            self._db.commit()
+
+    def _get_key(self, path):
+        return (os.path.getsize(path), os.path.getmtime(path),
+                os.path.getmtime(os.path.dirname(os.path.abspath(path))))
+
+    def get(self, path):
+        """
+        Returns: (infos, special_scenarios) for @path, None if @path is not
+                 in the index or changed since it was added
+        """
+        row = self._db.execute("SELECT size, mtime, dir_mtime, uri, protocol,"
+                               " duration, seekable, caps, tracks,"
+                               " special_scenarios FROM media_descriptors"
+                               " WHERE path = ?", (path, )).fetchone()
+        if row is None or tuple(row[:3]) != self._get_key(path):
+            return None
+
+        infos = {"uri": row[3],
+                 "protocol": row[4],
+                 "duration": long(row[5]),
+                 "seekable": row[6],
+                 "caps": row[7],
+                 "tracks": json.loads(row[8])}
+
+        return infos, [f for f in row[9].split("\n") if f]
+
+    def set(self, path, infos, special_scenarios):
+        self._db.execute("INSERT OR REPLACE INTO media_descriptors VALUES"
+                         " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (path, ) + self._get_key(path) +
+                         (infos["uri"], infos["protocol"], str(infos["duration"]),
+                          infos["seekable"], infos["caps"],
+                          json.dumps(infos["tracks"]),
+                          # Scenario file names can not contain new lines,
+                          # see ScenarioManager.find_special_scenarios_files
+                          "\n".join(special_scenarios)))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
 class PipelineDescriptor(object):
     def __init__(self, name, pipeline):
         self.name = name
@@ -140,6 +241,9 @@ if "win32" in sys.platform:
 G_V_MEDIA_INFO_EXT = "media_info"
 G_V_STREAM_INFO_EXT = "stream_info"
 
+# Name of the index of already parsed media descriptors in MAIN_DIR
+MEDIA_DESCRIPTORS_INDEX = "media_descriptors.db"
+
 # Some info about protocols and how to handle them
 G_V_CAPS_TO_PROTOCOL = [("application/x-hls", Protocols.HLS)]
 G_V_PROTOCOL_TIMEOUTS = {Protocols.HTTP: 120,
@@ -177,12 +281,12 @@ G_V_PROTOCOL_VIDEO_RESTRICTION_CAPS = {
 }
 
 G_V_BLACKLISTED_TESTS = \
-[# HLS known issues:
- ("validate.hls.playback.fast_forward.*",
+[# HLS known issues (also under the --network-profile ones):
+ ("validate.hls.*playback.fast_forward.*",
   "https://bugzilla.gnome.org/show_bug.cgi?id=698155"),
- ("validate.hls.playback.seek_with_stop.*",
+ ("validate.hls.*playback.seek_with_stop.*",
   "https://bugzilla.gnome.org/show_bug.cgi?id=723268"),
- ("validate.hls.playback.reverse_playback.*",
+ ("validate.hls.*playback.reverse_playback.*",
   "https://bugzilla.gnome.org/show_bug.cgi?id=702595"),
  ("validate.hls.*scrub_forward_seeking.*", "This is not stable enough for now."),
 
@@ -232,6 +336,13 @@ class GstValidateLaunchTest(GstValidateTest):
         GstValidateTest.build_arguments(self)
         self.add_arguments(self.pipeline_desc)
 
+    def get_input_files(self):
+        files = GstValidateTest.get_input_files(self)
+        if self.media_descriptor is not None:
+            files.extend(self.media_descriptor.get_files())
+
+        return files
+
     def get_current_value(self):
         if self.scenario:
             sent_eos = self.sent_eos_position()
@@ -266,6 +377,9 @@ class GstValidateMediaCheckTest(Test):
         self.add_arguments(self._uri, "--expected-results",
                            self._media_info_path)
 
+    def get_input_files(self):
+        return Test.get_input_files(self) + self.media_descriptor.get_files()
+
 
 class GstValidateTranscodingTest(GstValidateTest):
     _scenarios = ScenarioManager()
@@ -313,6 +427,10 @@ class GstValidateTranscodingTest(GstValidateTest):
         self.set_rendering_info()
         self.add_arguments(self.uri, self.dest_file)
 
+    def get_input_files(self):
+        return GstValidateTest.get_input_files(self) + \
+            self.media_descriptor.get_files()
+
     def get_current_value(self):
         if self.scenario:
             sent_eos = self.sent_eos_position()
@@ -356,6 +474,7 @@ class GstValidateManager(TestsManager, Loggable):
         TestsManager.__init__(self)
         Loggable.__init__(self)
         self._uris = []
+        self._media_index = None
         self._run_defaults = True
 
     def init(self):
@@ -402,61 +521,136 @@ use --wanted-tests defaults_only""")
                 classname = "validate.%s.transcode.to_%s.%s" % (mediainfo.media_descriptor.get_protocol(),
                                                                 str(comb).replace(' ', '_'),
                                                                 os.path.basename(uri).replace(".", "_"))
-                self.add_test(GstValidateTranscodingTest(classname,
-                                                         self.options,
-                                                         self.reporter,
-                                                         comb, uri,
-                                                         mediainfo.media_descriptor))
+                test_uri, tag = self._get_test_uri(uri, classname)
+                test = GstValidateTranscodingTest(classname,
+                                                  self.options,
+                                                  self.reporter,
+                                                  comb, test_uri,
+                                                  mediainfo.media_descriptor)
+                test.http_traffic_tag = tag
+                test.benchmark_group = (os.path.basename(uri), str(comb))
+                self.add_test(test)
         return self.tests
 
     def _check_discovering_info(self, media_info, uri=None):
         self.debug("Checking %s", media_info)
-        media_descriptor = MediaDescriptor(media_info)
+        cached = self._media_index.get(media_info)
+        if cached is not None:
+            self.debug("Using indexed infos for %s", media_info)
+            infos, special_scenarios_files = cached
+            media_descriptor = MediaDescriptor(media_info, infos)
+        else:
+            media_descriptor = MediaDescriptor(media_info)
+
         try:
-            # Just testing that the vairous mandatory infos are present
-            caps = media_descriptor.get_caps()
-            if uri is None:
+            if cached is None:
+                # Just testing that the vairous mandatory infos are present
+                caps = media_descriptor.get_caps()
+                if uri is None:
+                    uri = media_descriptor.get_uri()
+
+                media_descriptor.set_protocol(urlparse.urlparse(uri).scheme)
+                for caps2, prot in G_V_CAPS_TO_PROTOCOL:
+                    if caps2 == caps:
+                        media_descriptor.set_protocol(prot)
+                        break
+
+                scenario_bname = media_descriptor.get_media_filepath()
+                special_scenarios_files = \
+                    self._scenarios.find_special_scenarios_files(scenario_bname)
+                self._media_index.set(media_info, media_descriptor.get_infos(),
+                                      special_scenarios_files)
+            elif uri is None:
                 uri = media_descriptor.get_uri()
 
-            media_descriptor.set_protocol(urlparse.urlparse(uri).scheme)
-            for caps2, prot in G_V_CAPS_TO_PROTOCOL:
-                if caps2 == caps:
-                    media_descriptor.set_protocol(prot)
-                    break
+            # Only once indexed, the port can change from one run to the other
+            local_uri = self._use_http_server_port(uri)
+            if local_uri != uri:
+                uri = local_uri
+                media_descriptor.set_uri(uri)
 
-            scenario_bname = media_descriptor.get_media_filepath()
-            special_scenarios = self._scenarios.find_special_scenarios(scenario_bname)
+            # The special scenarios are discovered all at once
+            # in _list_uris
             self._uris.append((uri,
                                NamedDic({"path": media_info,
                                          "media_descriptor": media_descriptor}),
-                               special_scenarios))
+                               special_scenarios_files))
         except ConfigParser.NoOptionError as e:
             self.debug("Exception: %s for %s", e, media_info)
 
     def _discover_file(self, uri, fpath):
-        try:
-            media_info = "%s.%s" % (fpath, G_V_MEDIA_INFO_EXT)
-            args = G_V_DISCOVERER_COMMAND.split(" ")
-            args.append(uri)
-            if os.path.isfile(media_info):
-                self._check_discovering_info(media_info, uri)
-                return True
-            elif fpath.endswith(G_V_STREAM_INFO_EXT):
-                self._check_discovering_info(fpath)
-                return True
-            elif self.options.generate_info:
-                args.extend(["--output-file", media_info])
-            else:
-                return True
-
-            subprocess.check_output(args)
+        media_info = "%s.%s" % (fpath, G_V_MEDIA_INFO_EXT)
+        if os.path.isfile(media_info):
             self._check_discovering_info(media_info, uri)
+        elif fpath.endswith(G_V_STREAM_INFO_EXT):
+            self._check_discovering_info(fpath)
 
-            return True
-
+    def _generate_media_info(self, job):
+        fpath, media_info = job
+        args = G_V_DISCOVERER_COMMAND.split(" ")
+        args.extend([path2url(fpath), "--output-file", media_info])
+        try:
+            subprocess.check_output(args, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             self.debug("Exception: %s", e)
-            return False
+            return e
+
+        return None
+
+    def _generate_media_infos(self, fpaths):
+        """
+        Generates the missing media info files for @fpaths running up to
+        options.num_jobs discoverers at once.
+
+        Returns: The set of files for which it failed
+        """
+        jobs = []
+        for fpath in fpaths:
+            media_info = "%s.%s" % (fpath, G_V_MEDIA_INFO_EXT)
+            if not os.path.isfile(media_info) and \
+                    not fpath.endswith(G_V_STREAM_INFO_EXT):
+                jobs.append((fpath, media_info))
+
+        if not jobs:
+            return set()
+
+        num_jobs = min(max(self.options.num_jobs, 1), len(jobs))
+        printc("Generating %d media info files (%d jobs)" % (len(jobs), num_jobs),
+               Colors.OKBLUE)
+        pool = ThreadPool(num_jobs)
+        try:
+            # Results come back in the same order as the jobs, waiting with
+            # a timeout lets KeyboardInterrupt through
+            errors = pool.map_async(self._generate_media_info, jobs).get(sys.maxint)
+        finally:
+            pool.terminate()
+
+        failures = set()
+        for (fpath, media_info), error in zip(jobs, errors):
+            if error is not None:
+                printc("Could not generate %s: %s" % (media_info, error),
+                       Colors.WARNING)
+                failures.add(fpath)
+
+        return failures
+
+    def _discover_special_scenarios(self):
+        special_scenarios_files = []
+        for uri, minfo, files in self._uris:
+            special_scenarios_files.extend(files)
+
+        if not special_scenarios_files:
+            return
+
+        self._scenarios.cache_scenarios(special_scenarios_files)
+        uris = self._uris
+        self._uris = []
+        for uri, minfo, files in uris:
+            special_scenarios = []
+            if files:
+                special_scenarios = self._scenarios.discover_scenarios(
+                    files, minfo.media_descriptor.get_media_filepath())
+            self._uris.append((uri, minfo, special_scenarios))
 
     def _list_uris(self):
         if self._uris:
@@ -466,6 +660,7 @@ use --wanted-tests defaults_only""")
             if isinstance(self.options.paths, str):
                 self.options.paths = [os.path.join(self.options.paths)]
 
+            fpaths = []
             for path in self.options.paths:
                 for root, dirs, files in os.walk(path):
                     for f in files:
@@ -475,7 +670,30 @@ use --wanted-tests defaults_only""")
                                 fpath.endswith(ScenarioManager.FILE_EXTENDION):
                             continue
                         else:
-                            self._discover_file(path2url(fpath), fpath)
+                            fpaths.append(fpath)
+
+            # Only the media in the name of the tests we want can be used,
+            # the uris of the streams are only known once they are discovered
+            fpaths = [fpath for fpath in fpaths
+                      if fpath.endswith(G_V_STREAM_INFO_EXT) or
+                      self._is_name_wanted(os.path.basename(
+                          path2url(fpath)).replace(".", "_"))]
+
+            failures = set()
+            if self.options.generate_info:
+                failures = self._generate_media_infos(fpaths)
+
+            self._media_index = MediaDescriptorsIndex(
+                os.path.join(self.options.main_dir, MEDIA_DESCRIPTORS_INDEX))
+            try:
+                for fpath in fpaths:
+                    if fpath not in failures:
+                        self._discover_file(path2url(fpath), fpath)
+            finally:
+                self._media_index.close()
+                self._media_index = None
+
+            self._discover_special_scenarios()
 
         self.debug("Uris found: %s", self._uris)
 
@@ -487,9 +705,57 @@ use --wanted-tests defaults_only""")
 
         return "%s.%s.%s" % ("validate", protocol, "playback")
 
+    def _use_http_server_port(self, uri):
+        """
+        Returns: @uri pointing at the port of our http server if it points
+                 at the default one, as in the stream_info files of the assets
+        """
+        parsed = urlparse.urlparse(uri)
+        if parsed.netloc != "127.0.0.1:%d" % DEFAULT_HTTP_SERVER_PORT:
+            return uri
+
+        return urlparse.urlunparse(parsed._replace(
+            netloc="127.0.0.1:%d" % self.options.http_server_port))
+
+    def _is_served_locally(self, uri):
+        return urlparse.urlparse(uri).netloc == \
+            "127.0.0.1:%s" % self.options.http_server_port
+
+    def _get_test_uri(self, uri, classname):
+        """
+        Returns: The uri @classname should use so that its requests to our
+                 http server are recorded, and the tag of its requests
+                 (None if it does not use our http server)
+        """
+        if not self._is_served_locally(uri):
+            return uri, None
+
+        return get_traffic_tag_uri(uri, classname), classname
+
+    def _list_playback_uris(self):
+        """
+        Returns: (uri, mediainfo, special scenarios, name) tuples, with one
+                 more uri for each --network-profile for the media served
+                 by our http server, name then containing the profile name.
+                 The uris of HLS playlists are relative, so their variants
+                 and segments are served under the same profile.
+        """
+        uris = []
+        for uri, minfo, special_scenarios in self._list_uris():
+            protocol = minfo.media_descriptor.get_protocol()
+            uris.append((uri, minfo, special_scenarios, protocol))
+            if not self._is_served_locally(uri):
+                continue
+
+            for profile in self.options.network_profiles:
+                uris.append((get_network_profile_uri(uri, profile), minfo,
+                             special_scenarios, "%s.%s" % (protocol, profile)))
+
+        return uris
+
     def _add_playback_test(self, pipe_descriptor):
         if pipe_descriptor.needs_uri():
-            for uri, minfo, special_scenarios in self._list_uris():
+            for uri, minfo, special_scenarios, name in self._list_playback_uris():
                 protocol = minfo.media_descriptor.get_protocol()
                 if self._run_defaults:
                     scenarios = [self._scenarios.get_scenario(scenario_name)
@@ -502,23 +768,26 @@ use --wanted-tests defaults_only""")
                     if not minfo.media_descriptor.is_compatible(scenario):
                         continue
 
-                    npipe = pipe_descriptor.get_pipeline(self.options,
-                                                         protocol,
-                                                         scenario,
-                                                         uri)
-
                     fname = "%s.%s" % (self._get_fname(scenario,
-                                       protocol),
+                                       name),
                                        os.path.basename(uri).replace(".", "_"))
                     self.debug("Adding: %s", fname)
 
-                    self.add_test(GstValidateLaunchTest(fname,
-                                                        self.options,
-                                                        self.reporter,
-                                                        npipe,
-                                                        scenario=scenario,
-                                                        media_descriptor=minfo.media_descriptor)
-                                 )
+                    test_uri, tag = self._get_test_uri(uri, fname)
+                    npipe = pipe_descriptor.get_pipeline(self.options,
+                                                         protocol,
+                                                         scenario,
+                                                         test_uri)
+
+                    test = GstValidateLaunchTest(fname,
+                                                 self.options,
+                                                 self.reporter,
+                                                 npipe,
+                                                 scenario=scenario,
+                                                 media_descriptor=minfo.media_descriptor)
+                    test.http_traffic_tag = tag
+                    test.benchmark_group = (os.path.basename(uri), name)
+                    self.add_test(test)
         else:
             self.add_test(GstValidateLaunchTest(self._get_fname(scenario, "testing"),
                                                 self.options,
@@ -529,11 +798,9 @@ use --wanted-tests defaults_only""")
     def needs_http_server(self):
         for test in self.list_tests():
             if self._is_test_wanted(test):
-                protocol = test.media_descriptor.get_protocol()
-                uri = test.media_descriptor.get_uri()
-
-                if protocol == Protocols.HTTP and \
-                    "127.0.0.1:%s" % (self.options.http_server_port) in uri:
+                # HTTP and HLS media
+                if test.media_descriptor is not None and \
+                        self._is_served_locally(test.media_descriptor.get_uri()):
                     return True
         return False
 
@@ -545,3 +812,7 @@ use --wanted-tests defaults_only""")
         if options.wanted_tests and not [d for d in options.wanted_tests
                                          if "defaults_only" in d]:
             self._run_defaults = False
+        # The failed tests may have used any scenario, the set of tests
+        # to rerun already limits what runs
+        if options.rerun_tests is not None:
+            self._run_defaults = False
@@ -23,17 +23,63 @@ import os
 import sys
 import re
 import time
+import errno
+import json
+import Queue
+import shutil
+import hashlib
+import glob
 import utils
+import sqlite3
 import signal
+import socket
+import urllib2
 import urlparse
+import threading
 import subprocess
 import reporters
 import ConfigParser
+import RangeHTTPServer
 from loggable import Loggable
 from optparse import OptionGroup
 
 from utils import mkdir, Result, Colors, printc, DEFAULT_TIMEOUT, GST_SECOND
 
+# Name of the cache of scenario definitions in MAIN_DIR
+SCENARIOS_CACHE = "scenarios_cache.db"
+# Name of the database of tests running times in MAIN_DIR
+TESTS_HISTORY = "tests_history.db"
+# Cost (in seconds) of running a test on top of its expected duration,
+# used to balance shards
+SHARD_TEST_OVERHEAD = 1
+# Name of the database of the cached test results in MAIN_DIR, and of the
+# directory where the logs of those tests are kept
+RESULTS_CACHE = "results_cache.db"
+RESULTS_CACHE_LOGS = "results_cache"
+# Name of the journal of the tests that finished in LOGSDIR
+RUN_JOURNAL = "run_journal.jsonl"
+# Part of the resource samples of a test considered as its startup, not
+# taken into account to compute the growth of its resource usage
+RESOURCES_WARMUP_RATIO = 1 / 3.0
+# Minimum number of samples (or --forever iterations) to compute a growth
+MIN_GROWTH_SAMPLES = 3
+# Number of runs in a row in which a test failed every time it was retried
+# after which it is not retried anymore, until it passes again
+RETRY_MAX_FAILED_RUNS = 3
+# (property, title, format) of the figures summed up in tables, with a row
+# and a column per Test.benchmark_group, in the benchmark report
+BENCHMARK_TABLES = [("benchmark_time_to_playing_ms",
+                     "Startup latency, time to PLAYING (median ms)", "%.1f"),
+                    ("benchmark_time_to_first_position_ms",
+                     "Time to the first position (median ms)", "%.1f"),
+                    ("benchmark_realtime_factor",
+                     "Real-time factor, media seconds per wall second (median)", "%.2f"),
+                    ("benchmark_output_bytes_per_second",
+                     "Output throughput (median bytes per second)", "%d")]
+# Figures that fail the tests when they drop compared to --benchmark-baseline
+BENCHMARK_THROUGHPUTS = ["benchmark_realtime_factor",
+                         "benchmark_output_bytes_per_second"]
+
 
 class Test(Loggable):
 
@@ -57,6 +103,14 @@ class Test(Loggable):
         self.reporter = reporter
         self.process = None
         self.duration = duration
+        # Tag of the requests made to our HTTP server by the test
+        self.http_traffic_tag = None
+        # Whether run() prints the command and the result of the test, the
+        # launcher prints them in order itself when running tests in parallel
+        self.verbose = True
+        # (row, column) of the test in the tables of the benchmark report,
+        # for example (media, protocol)
+        self.benchmark_group = None
 
         self.clean()
 
@@ -65,14 +119,35 @@ class Test(Loggable):
         self.error_str = ""
         self.time_taken = 0.0
         self._starting_time = None
+        # time.time() right before the process got spawned
+        self._spawn_time = None
         self.result = Result.NOT_RUN
         self.logfile = None
+        self.out = None
         self.extra_logfiles = []
+        # Resource usage of the process, when the platform gives it
+        self.rusage = None
+        # (time, RSS, open fds, threads) of the process while running
+        self._resources_samples = []
+        # Values to report along with the result
+        self.properties = {}
+        # Key of the test in the results cache
+        self.cache_key = None
+        # Where the result comes from when the test did not run
+        # ("cached" or "resumed")
+        self.restored = None
+        # (result, message, logfile) of the attempts that failed before
+        # the test was retried
+        self.failed_attempts = []
 
     def __str__(self):
         string = self.classname
         if self.result != Result.NOT_RUN:
             string += ": " + self.result
+            if "cpu_user" in self.properties:
+                string += " (CPU: %ss user %ss system, max RSS: %s KB)" % (
+                    self.properties["cpu_user"], self.properties["cpu_system"],
+                    self.properties["max_rss_kb"])
             if self.result in [Result.FAILED, Result.TIMEOUT]:
                 string += " '%s'\n" \
                           "       You can reproduce with: %s\n" \
@@ -84,15 +159,14 @@ class Test(Loggable):
 
         return string
 
-    def get_extra_log_content(self, extralog):
+    def iter_extra_log_content(self, extralog):
+        """ Yields the content of @extralog in chunks """
         if extralog not in self.extra_logfiles:
-            return ""
-
-        f = open(extralog, 'r+')
-        value = f.read()
-        f.close()
+            return
 
-        return value
+        with open(extralog, 'r') as f:
+            for chunk in iter(lambda: f.read(utils.LOG_CHUNK_SIZE), ""):
+                yield chunk
 
 
     def get_classname(self):
@@ -111,6 +185,65 @@ class Test(Loggable):
     def build_arguments(self):
         pass
 
+    def build_command(self):
+        self.command = "%s " % (self.application)
+        self.build_arguments()
+
+        return self.command
+
+    def get_input_files(self):
+        """
+        Returns: The paths of the files, on top of its command line, the
+                 result of the test depends on
+        """
+        return []
+
+    def set_stored_result(self, result, message, time_taken, properties,
+                          logfile, extra_logfiles, restored):
+        """
+        Sets the result of the test as stored when it ran previously,
+        without running it.
+        """
+        # Results are compared by identity with the Result ones
+        self.set_result(intern(str(result)), message)
+        self.time_taken = time_taken
+        self.properties = properties
+        self.logfile = logfile
+        self.out = open(logfile, 'r')
+        self.extra_logfiles = extra_logfiles
+        self.restored = restored
+
+    def collect_benchmark(self):
+        """
+        Reports the performance figures measured while the test ran as
+        benchmark_* properties, see --benchmark
+        """
+        pass
+
+    def check_benchmark_baseline(self):
+        """
+        Fails the test if one of its BENCHMARK_THROUGHPUTS dropped by more
+        than options.benchmark_tolerance percents compared to
+        options.benchmark_baseline
+        """
+        if self.result != Result.PASSED:
+            return
+
+        baseline = self.options.benchmark_baseline.get(self.classname, {})
+        for name in BENCHMARK_THROUGHPUTS:
+            if name not in baseline or name not in self.properties:
+                continue
+
+            value = float(self.properties[name])
+            reference = float(baseline[name])
+            if value < reference * (1 - self.options.benchmark_tolerance / 100.0):
+                self.set_result(Result.FAILED,
+                                "%s dropped to %s (baseline: %s)"
+                                % (name.replace("benchmark_", "", 1),
+                                   self.properties[name], baseline[name]),
+                                "throughput-regression")
+                return
+
     def set_result(self, result, message="", error=""):
         self.debug("Setting result: %s (message: %s, error: %s", result,
                    message, error)
@@ -148,22 +281,119 @@ class Test(Loggable):
         """
         return Result.NOT_RUN
 
+    def _reap_process(self):
+        """
+        Waits for the process of the test to exit, getting its resource
+        usage when the platform allows it
+        """
+        if not hasattr(os, "wait4"):
+            self.process.wait()
+            return
+
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.process.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    self.process.wait()
+                    return
+
+        # Set before the return code, which tells the process exited
+        self.rusage = rusage
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+
+    def collect_rusage(self):
+        """ Reports the resource usage of the process in the test properties """
+        max_rss = self.rusage.ru_maxrss
+        if sys.platform == "darwin":
+            # In bytes instead of kilobytes
+            max_rss /= 1024
+
+        self.properties.update({
+            "cpu_user": "%.3f" % self.rusage.ru_utime,
+            "cpu_system": "%.3f" % self.rusage.ru_stime,
+            "max_rss_kb": max_rss,
+            "io_read_blocks": self.rusage.ru_inblock,
+            "io_write_blocks": self.rusage.ru_oublock,
+            "voluntary_switches": self.rusage.ru_nvcsw,
+            "involuntary_switches": self.rusage.ru_nivcsw})
+
+    def _sample_resources(self):
+        pid = self.process.pid
+        try:
+            with open("/proc/%d/status" % pid) as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+            sample = (time.time(), int(status["VmRSS"].split()[0]) * 1024,
+                      len(os.listdir("/proc/%d/fd" % pid)),
+                      int(status["Threads"]))
+        except (IOError, OSError, KeyError, ValueError):
+            # No /proc on that platform, or the process exited
+            return
+
+        self._resources_samples.append(sample)
+
+    def collect_resources_growth(self):
+        """
+        Reports how fast the memory, file descriptors and threads used by
+        the process grew once it started up, failing the test if its
+        memory grew faster than options.max_rss_growth.
+        """
+        samples = self._resources_samples
+        if not samples:
+            return
+
+        self.properties["max_fds"] = max(fds for t, rss, fds, threads in samples)
+        self.properties["max_threads"] = max(threads for t, rss, fds, threads in samples)
+        samples = samples[int(len(samples) * RESOURCES_WARMUP_RATIO):]
+        if len(samples) < MIN_GROWTH_SAMPLES:
+            return
+
+        rss_growth = utils.get_slope([(t, rss) for t, rss, fds, threads in samples])
+        if rss_growth is None:
+            return
+
+        self.properties["rss_growth"] = "%d" % rss_growth
+        self.properties["fds_growth"] = "%.3f" % utils.get_slope(
+            [(t, fds) for t, rss, fds, threads in samples])
+        self.properties["threads_growth"] = "%.3f" % utils.get_slope(
+            [(t, threads) for t, rss, fds, threads in samples])
+        if self.options.max_rss_growth is not None and \
+                rss_growth > self.options.max_rss_growth and \
+                self.result == Result.PASSED:
+            self.set_result(Result.FAILED,
+                            "Memory grew by %d bytes per second (more than %d)"
+                            % (rss_growth, self.options.max_rss_growth),
+                            "memory-growth")
+
+    def _samples_resources(self):
+        return self.options.forever or self.options.max_rss_growth is not None
+
     def wait_process(self):
         last_val = 0
         last_change_ts = time.time()
         start_ts = time.time()
+
+        # Reap the process from a dedicated thread so that we get woken up
+        # as soon as it exits, the timeout checks are run every
+        # options.timeout_check_interval seconds in the meantime.
+        waiter = threading.Thread(target=self._reap_process)
+        waiter.daemon = True
+        waiter.start()
         while True:
-            self.process.poll()
+            waiter.join(self.options.timeout_check_interval)
             if self.process.returncode is not None:
                 break
 
-            # Dirty way to avoid eating to much CPU...
-            # good enough for us anyway.
-            time.sleep(1)
+            if self._samples_resources():
+                self._sample_resources()
 
             val = self.get_current_value()
 
-            self.debug("Got value: %s" % val)
+            self.debug("Got value: %s", val)
             if val is Result.NOT_RUN:
                 # The get_current_value logic is not implemented... dumb timeout
                 if time.time() - last_change_ts > self.timeout:
@@ -175,11 +405,11 @@ class Test(Loggable):
             elif val is Result.KNOWN_ERROR:
                 break
 
-            self.log("New val %s" % val)
+            self.log("New val %s", val)
 
             if val == last_val:
                 delta = time.time() - last_change_ts
-                self.debug("%s: Same value for %d/%d seconds" % (self, delta, self.timeout))
+                self.debug("%s: Same value for %d/%d seconds", self, delta, self.timeout)
                 if delta > self.timeout:
                     self.set_result(Result.TIMEOUT)
                     break
@@ -195,10 +425,42 @@ class Test(Loggable):
     def get_subproc_env(self):
         return os.environ
 
+    def collect_http_traffic(self):
+        """
+        Gets the requests the test made to our HTTP server, logging them
+        and reporting a summary in the test properties
+        """
+        uri = RangeHTTPServer.get_traffic_stats_uri("127.0.0.1",
+                                                    self.options.http_server_port,
+                                                    self.http_traffic_tag)
+        try:
+            requests = json.load(urllib2.urlopen(uri, timeout=10))
+        except (urllib2.URLError, socket.error, ValueError) as e:
+            self.warning("Could not get the HTTP traffic of %s: %s",
+                         self.classname, e)
+            return
+
+        trafficlog = self.logfile + '.http_traffic'
+        with open(trafficlog, 'w') as f:
+            for request in requests:
+                f.write(json.dumps(request, sort_keys=True) + "\n")
+        self.extra_logfiles.append(trafficlog)
+
+        ttfbs = [request["ttfb"] for request in requests
+                 if request["ttfb"] is not None]
+        connections = set(request["connection"] for request in requests)
+        self.properties.update({
+            "http_requests": len(requests),
+            "http_range_requests": len([r for r in requests if r["range"]]),
+            "http_bytes": sum(request["bytes"] for request in requests),
+            "http_reconnects": max(len(connections) - 1, 0)})
+        if ttfbs:
+            self.properties["http_mean_ttfb"] = "%.3f" % (sum(ttfbs) / len(ttfbs))
+            self.properties["http_max_ttfb"] = "%.3f" % max(ttfbs)
+
     def run(self):
-        self.command = "%s " % (self.application)
         self._starting_time = time.time()
-        self.build_arguments()
+        self.build_command()
         proc_env = self.get_subproc_env()
 
         message = "Launching: %s%s\n" \
@@ -209,13 +471,18 @@ class Test(Loggable):
         for log in self.extra_logfiles:
             message += "\n         - %s" % log
 
-        printc(message, Colors.OKBLUE)
+        if self.verbose:
+            printc(message, Colors.OKBLUE)
 
         try:
+            self._spawn_time = time.time()
+            # Tests can be started from several threads at once, do not
+            # let them inherit the files of each other
             self.process = subprocess.Popen("exec " + self.command,
-                                            stderr=self.reporter.out,
-                                            stdout=self.reporter.out,
+                                            stderr=self.out,
+                                            stdout=self.out,
                                             shell=True,
+                                            close_fds=True,
                                             env=proc_env)
             self.wait_process()
         except KeyboardInterrupt:
@@ -223,30 +490,220 @@ class Test(Loggable):
             raise
 
         try:
-            self.process.send_signal(signal.SIGINT)
+            if self.process.returncode is None:
+                self.process.send_signal(signal.SIGINT)
         except OSError:
             pass
 
         self.time_taken = time.time() - self._starting_time
 
-        self.reporter.out.seek(0)
-        self.reporter.out.write("=================\n"
-                                "Test name: %s\n"
-                                "Command: '%s'\n"
-                                "=================\n\n"
-                                % (self.classname, self.command))
-        printc("Result: %s%s\n" % (self.result,
-               " (" + self.message + ")" if self.message else ""),
-               color=utils.get_color_for_result(self.result))
+        # Not known for processes that did not exit (timeouts)
+        if self.rusage is not None:
+            self.collect_rusage()
+        self.collect_resources_growth()
+        if self.options.benchmark:
+            self.collect_benchmark()
+            if self.options.benchmark_baseline is not None:
+                self.check_benchmark_baseline()
+
+        if self.http_traffic_tag is not None:
+            self.collect_http_traffic()
+
+        self.out.seek(0)
+        self.out.write("=================\n"
+                       "Test name: %s\n"
+                       "Command: '%s'\n"
+                       "=================\n\n"
+                       % (self.classname, self.command))
+        if self.verbose:
+            printc("Result: %s%s\n" % (self.result,
+                   " (" + self.message + ")" if self.message else ""),
+                   color=utils.get_color_for_result(self.result))
 
         return self.result
 
 
-class GstValidateTest(Test):
+class GstValidateLogsFollower(Loggable):
 
-    """ A class representing a particular test. """
+    """
+    Follows the GST_VALIDATE_FILE of a running test, only parsing what
+    has been appended since the last call to update() and keeping the
+    latest interesting values in memory.
+    """
     findpos_regex = re.compile('.*position.*(\d+):(\d+):(\d+).(\d+).*duration.*(\d+):(\d+):(\d+).(\d+)')
     findlastseek_regex = re.compile('seeking to.*(\d+):(\d+):(\d+).(\d+).*stop.*(\d+):(\d+):(\d+).(\d+).*rate.*(\d+)\.(\d+)')
+    record_separator_regex = re.compile('[\r\n]')
+
+    def __init__(self, path):
+        Loggable.__init__(self)
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self._offset = 0
+        self._pending = ""
+
+        self.position = -1
+        self.duration = -1
+        self.last_seek = (None, None, None)
+        self.sent_eos_time = None
+        self.criticals = []
+
+    def update(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError as e:
+            self.debug("Could not open %s: %s", self.path, e)
+            return
+
+        try:
+            if os.fstat(f.fileno()).st_size < self._offset:
+                self.debug("%s has been truncated, starting over", self.path)
+                self.reset()
+            f.seek(self._offset)
+            data = f.read()
+        finally:
+            f.close()
+
+        if not data:
+            return
+
+        self._offset += len(data)
+        # Positions are separated by '\r' and other messages by '\n', the
+        # last record might not be completely written yet.
+        records = self.record_separator_regex.split(self._pending + data)
+        self._pending = records.pop()
+        for record in records:
+            self._parse_record(record)
+
+    def _parse_record(self, record):
+        if "critical : " in record:
+            error = record.split("critical : ")[1]
+            if error not in self.criticals:
+                self.criticals.append(error)
+            return
+
+        record = record.strip().lower()
+        if record.startswith("<position:") and record.endswith("/>"):
+            self.position, self.duration = self._parse_position(record)
+        elif record.startswith("buffering") and record.endswith("%"):
+            self.position, self.duration = self._parse_buffering(record)
+        elif "seeking to: " in record:
+            self.last_seek = self._parse_seek(record)
+        elif "sending eos" in record and self.sent_eos_time is None:
+            self.sent_eos_time = time.time()
+
+    def _parse_position(self, p):
+        self.log("Parsing %s", p)
+        times = self.findpos_regex.findall(p)
+
+        if len(times) != 1:
+            self.warning("Got a unparsable value: %s", p)
+            return 0, 0
+
+        return (utils.gsttime_from_tuple(times[0][:4]),
+                utils.gsttime_from_tuple(times[0][4:]))
+
+    def _parse_buffering(self, b):
+        return b.split("buffering... ")[1].split("%")[0], 100
+
+    def _parse_seek(self, s):
+        values = self.findlastseek_regex.findall(s)
+        if len(values) != 1:
+            self.warning("Got a unparsable value: %s", s)
+            return None, None, None
+
+        v = values[0]
+        return (utils.gsttime_from_tuple(v[:4]),
+                utils.gsttime_from_tuple(v[4:8]),
+                float(str(v[8]) + "." + str(v[9])))
+
+
+class GstValidateProgressFollower(GstValidateLogsFollower):
+
+    """
+    Follows the GST_VALIDATE_PROGRESS_FILE of a running test. It contains
+    one space separated record per line (position, seek, eos, buffering)
+    with times in nanoseconds so it can be parsed without any regex.
+    """
+    record_separator_regex = re.compile('\n')
+
+    def reset(self):
+        GstValidateLogsFollower.reset(self)
+        # Set as soon as we know the gst-validate tools support it
+        self.version = None
+        # Time (in nanoseconds) it took to complete each seek, the
+        # seeks being sent one after the other (from version 2)
+        self.seek_latencies = []
+        self.first_seek_time = None
+        self.last_seek_done_time = None
+        self._seek_time = None
+        # (monotonic, real) times at which the process started to write
+        # records, relating the timestamps of the records to time.time()
+        # (from version 3)
+        self.clock = None
+        # Timestamps at which the pipeline first reached each state
+        self.state_times = {}
+        # Timestamp of the first record with a known position
+        self.first_position_time = None
+        # Last known position
+        self.last_known_position = None
+
+    def get_wall_time(self, timestamp):
+        """
+        Returns: @timestamp, taken from a record, as a time.time() value or
+                 None if the records do not allow it
+        """
+        if self.clock is None or timestamp is None:
+            return None
+
+        return float(self.clock[1] + timestamp - self.clock[0]) / GST_SECOND
+
+    def _parse_record(self, record):
+        fields = record.split(" ")
+        try:
+            if fields[0] == "position":
+                self.position = long(fields[1])
+                self.duration = long(fields[2])
+                if self.position >= 0:
+                    timestamp = long(fields[4]) if len(fields) > 4 else None
+                    if self.first_position_time is None:
+                        self.first_position_time = timestamp
+                    self.last_known_position = self.position
+            elif fields[0] == "buffering":
+                self.position = int(fields[1])
+                self.duration = 100
+            elif fields[0] == "seek":
+                self.last_seek = (long(fields[1]), long(fields[2]),
+                                  float(fields[3]))
+                if len(fields) > 4:
+                    self._seek_time = long(fields[4])
+                    if self.first_seek_time is None:
+                        self.first_seek_time = self._seek_time
+            elif fields[0] == "seek-done":
+                if self._seek_time is not None:
+                    self.last_seek_done_time = long(fields[1])
+                    self.seek_latencies.append(self.last_seek_done_time -
+                                               self._seek_time)
+                    self._seek_time = None
+            elif fields[0] == "eos":
+                if self.sent_eos_time is None:
+                    self.sent_eos_time = time.time()
+            elif fields[0] == "state":
+                self.state_times.setdefault(fields[1], long(fields[2]))
+            elif fields[0] == "clock":
+                self.clock = (long(fields[1]), long(fields[2]))
+            elif fields[0] == "version":
+                self.version = int(fields[1])
+            else:
+                self.log("Unhandled record: %s", record)
+        except (IndexError, ValueError):
+            self.warning("Got a unparsable record: %s", record)
+
+
+class GstValidateTest(Test):
+
+    """ A class representing a particular test. """
 
     def __init__(self, application_name, classname,
                  options, reporter, duration=0,
@@ -256,11 +713,9 @@ class GstValidateTest(Test):
                                               reporter, duration=duration,
                                               timeout=timeout, hard_timeout=hard_timeout)
 
-        # defines how much the process can be outside of the configured
-        # segment / seek
-        self._sent_eos_pos = None
-
         self.validatelogs = None
+        # File the test renders to, if any
+        self.dest_file = None
         if scenario is None or scenario.name.lower() == "none":
             self.scenario = None
         else:
@@ -271,9 +726,15 @@ class GstValidateTest(Test):
 
         self.validatelogs = self.logfile + '.validate.logs'
         utils.touch(self.validatelogs)
+        self._validatelogs_follower = GstValidateLogsFollower(self.validatelogs)
         subproc_env["GST_VALIDATE_FILE"] = self.validatelogs
         self.extra_logfiles.append(self.validatelogs)
 
+        progressfile = self.logfile + '.validate.progress'
+        utils.touch(progressfile)
+        self._progress_follower = GstValidateProgressFollower(progressfile)
+        subproc_env["GST_VALIDATE_PROGRESS_FILE"] = progressfile
+
         if 'GST_DEBUG' in os.environ:
             gstlogsfile = self.logfile + '.gstdebug'
             self.extra_logfiles.append(gstlogsfile)
@@ -283,37 +744,106 @@ class GstValidateTest(Test):
 
     def clean(self):
         Test.clean(self)
-        self._sent_eos_pos = None
+        self._validatelogs_follower = None
+        self._progress_follower = None
 
     def build_arguments(self):
         if self.scenario is not None:
             self.add_arguments("--set-scenario",
                                self.scenario.get_execution_name())
 
-    def get_extra_log_content(self, extralog):
-        value = Test.get_extra_log_content(self, extralog)
+    def get_input_files(self):
+        files = Test.get_input_files(self)
+        if self.scenario is not None:
+            path = ScenarioManager().find_scenario_file(self.scenario)
+            if path is not None:
+                files.append(path)
+
+        return files
+
+    def _strip_positions(self, chunks):
+        pending = ""
+        for chunk in chunks:
+            pending += chunk
+            # Only strip complete records
+            end = max(pending.rfind("\r"), pending.rfind("\n")) + 1
+            if end:
+                yield re.sub("<position:.*/>\r", "", pending[:end])
+                pending = pending[end:]
+
+        yield re.sub("<position:.*/>\r", "", pending)
+
+    def iter_extra_log_content(self, extralog):
+        chunks = Test.iter_extra_log_content(self, extralog)
 
         if extralog == self.validatelogs:
-            value = re.sub("<position:.*/>\r", "", value)
+            chunks = self._strip_positions(chunks)
+
+        return chunks
+
+    def collect_benchmark(self):
+        Test.collect_benchmark(self)
+        if self._progress_follower is None:
+            return
+
+        progress = self._progress_follower
+        progress.update()
+        self._collect_startup_latency(progress)
+        if self.dest_file:
+            self._collect_throughput(progress)
+        latencies = [float(latency) / GST_SECOND * 1000
+                     for latency in progress.seek_latencies]
+        if not latencies:
+            return
+
+        self.properties.update({
+            "benchmark_seeks": len(latencies),
+            "benchmark_seek_latency_p50_ms": "%.3f" % utils.get_percentile(latencies, 50),
+            "benchmark_seek_latency_p95_ms": "%.3f" % utils.get_percentile(latencies, 95),
+            "benchmark_seek_latency_max_ms": "%.3f" % max(latencies)})
+        if len(latencies) > 1:
+            self.properties["benchmark_seeks_per_second"] = "%.2f" % (
+                len(latencies) * float(GST_SECOND) /
+                (progress.last_seek_done_time - progress.first_seek_time))
+
+    def _collect_startup_latency(self, progress):
+        if self._spawn_time is None:
+            return
+
+        for name, timestamp in [("startup", progress.clock and progress.clock[0]),
+                                ("time_to_paused", progress.state_times.get("PAUSED")),
+                                ("time_to_playing", progress.state_times.get("PLAYING")),
+                                ("time_to_first_position", progress.first_position_time)]:
+            wall_time = progress.get_wall_time(timestamp)
+            if wall_time is not None:
+                self.properties["benchmark_%s_ms" % name] = "%.3f" % (
+                    (wall_time - self._spawn_time) * 1000)
+
+    def _collect_throughput(self, progress):
+        # Both figures are per second of the whole run of the test so that
+        # they can be compared
+        if self.time_taken <= 0:
+            return
+
+        if progress.last_known_position is not None:
+            self.properties["benchmark_realtime_factor"] = "%.3f" % (
+                float(progress.last_known_position) / GST_SECOND / self.time_taken)
+
+        try:
+            size = os.stat(utils.url2path(self.dest_file)).st_size
+        except OSError:
+            return
 
-        return value
+        self.properties["benchmark_output_bytes_per_second"] = "%d" % (
+            size / self.time_taken)
 
     def get_validate_criticals_errors(self):
-        ret = "["
-        errors = []
-        for l in open(self.validatelogs, 'r').readlines():
-            if "critical : " in l:
-                if ret != "[":
-                    ret += ", "
-                error = l.split("critical : ")[1].replace("\n", '')
-                if error not in errors:
-                    ret += error
-                    errors.append(error)
-
-        if ret == "[":
+        self._validatelogs_follower.update()
+        errors = self._validatelogs_follower.criticals
+        if not errors:
             return "No critical"
-        else:
-            return ret + "]"
+
+        return "[" + ", ".join(errors) + "]"
 
     def check_results(self):
         if self.result is Result.FAILED or self.result is Result.PASSED:
@@ -337,88 +867,30 @@ class GstValidateTest(Test):
                                 self.process.returncode,
                                 self.get_validate_criticals_errors()
                                 ))
-    def _parse_position(self, p):
-        self.log("Parsing %s" % p)
-        times = self.findpos_regex.findall(p)
 
-        if len(times) != 1:
-            self.warning("Got a unparsable value: %s" % p)
-            return 0, 0
-
-        return (utils.gsttime_from_tuple(times[0][:4]),
-                utils.gsttime_from_tuple(times[0][4:]))
-
-
-    def _parse_buffering(self, b):
-        return b.split("buffering... ")[1].split("%")[0], 100
+    def _get_progress(self):
+        """
+        Returns an up to date follower to get the progress of the test from,
+        falling back to parsing the validate logs if the tools in use do not
+        write the progress file.
+        """
+        self._progress_follower.update()
+        if self._progress_follower.version is not None:
+            return self._progress_follower
 
+        self._validatelogs_follower.update()
+        return self._validatelogs_follower
 
     def _get_position(self):
-        position = duration = -1
-
-        self.debug("Getting position")
-        m = None
-        for l in reversed(open(self.validatelogs, 'r').readlines()):
-            l = l.lower()
-            if "<position:" in l or "buffering" in l:
-                m = l
-                break
+        progress = self._get_progress()
 
-        if m is None:
-            self.debug("Could not fine any positionning info")
-            return position, duration
-
-        for j in m.split("\r"):
-            j = j.lstrip().rstrip()
-            if j.startswith("<position:") and j.endswith("/>"):
-                position, duration = self._parse_position(j)
-            elif j.startswith("buffering") and j.endswith("%"):
-                position, duration = self._parse_buffering(j)
-            else:
-                self.log("No info in %s" % j)
-
-        return position, duration
+        return progress.position, progress.duration
 
     def _get_last_seek_values(self):
-        m = None
-        rate = start = stop = None
-
-        for l in reversed(open(self.validatelogs, 'r').readlines()):
-            l = l.lower()
-            if "seeking to: " in l:
-                m = l
-                break
-
-        if m is None:
-            self.debug("Could not fine any seeking info")
-            return start, stop, rate
-
-
-        values = self.findlastseek_regex.findall(m)
-        if len(values) != 1:
-            self.warning("Got a unparsable value: %s" % p)
-            return start, stop, rate
-
-        v = values[0]
-        return (utils.gsttime_from_tuple(v[:4]),
-                utils.gsttime_from_tuple(v[4:8]),
-                float(str(v[8]) + "." + str(v[9])))
+        return self._get_progress().last_seek
 
     def sent_eos_position(self):
-        if self._sent_eos_pos is not None:
-            return self._sent_eos_pos
-
-        m = None
-        rate = start = stop = None
-
-        for l in reversed(open(self.validatelogs, 'r').readlines()):
-            l = l.lower()
-            if "sending eos" in l:
-                m = l
-                self._sent_eos_pos = time.time()
-                return self._sent_eos_pos
-
-        return None
+        return self._get_progress().sent_eos_time
 
     def get_current_position(self):
         position, duration = self._get_position()
@@ -432,11 +904,11 @@ class GstValidateTest(Test):
         position = self.get_current_position()
 
         try:
-            size = os.stat(urlparse.urlparse(self.dest_file).path).st_size
+            size = os.stat(utils.url2path(self.dest_file)).st_size
         except OSError as e:
             return position
 
-        self.debug("Size: %s" % size)
+        self.debug("Size: %s", size)
         return size
 
 
@@ -457,6 +929,8 @@ class TestsManager(Loggable):
         self.reporter = None
         self.wanted_tests_patterns = []
         self.blacklisted_tests_patterns = []
+        # Names (as returned by Test.get_name) of the tests to rerun
+        self._rerun_names = None
 
     def init(self):
         return False
@@ -496,6 +970,18 @@ class TestsManager(Loggable):
                 for pattern in patterns.split(","):
                     self.blacklisted_tests_patterns.append(re.compile(pattern))
 
+        if options.rerun_tests is not None:
+            self._rerun_names = set(classname.split('.')[-1]
+                                    for classname in options.rerun_tests)
+
+    def _is_name_wanted(self, name):
+        """
+        Returns: Whether tests whose name (as returned by Test.get_name) is
+                 @name can be wanted, so that testers can skip discovering
+                 what they would need for the other ones
+        """
+        return self._rerun_names is None or name in self._rerun_names
+
     def _check_blacklisted(self, test):
         for pattern in self.blacklisted_tests_patterns:
             if pattern.findall(test.classname):
@@ -509,10 +995,13 @@ class TestsManager(Loggable):
 
         if test.duration > 0 and int(self.options.long_limit) < int(test.duration):
             self.info("Not activating test as it duration (%d) is superior"
-                      " than the long limit (%d)" % (test.duration,
-                                                     int(self.options.long_limit)))
+                      " than the long limit (%d)", test.duration,
+                      int(self.options.long_limit))
             return False
 
+        if self.options.rerun_tests is not None and \
+                test.classname not in self.options.rerun_tests:
+            return False
 
         if not self.wanted_tests_patterns:
             return True
@@ -523,20 +1012,6 @@ class TestsManager(Loggable):
 
         return False
 
-    def run_tests(self, cur_test_num, total_num_tests):
-        i = cur_test_num
-        for test in self.tests:
-            sys.stdout.write("[%d / %d] " % (i, total_num_tests))
-            self.reporter.before_test(test)
-            res = test.run()
-            i += 1
-            self.reporter.after_test()
-            if res != Result.PASSED and (self.options.forever or
-                                         self.options.fatal_error):
-                return test.result
-
-        return Result.PASSED
-
     def clean_tests(self):
         for test in self.tests:
             test.clean()
@@ -545,6 +1020,374 @@ class TestsManager(Loggable):
         return False
 
 
+class TestsHistory(Loggable):
+    """
+    Keeps track of the time each test took to run in previous runs, so that
+    the longest tests can be started first, and of how often they turned
+    out to be flaky or to fail consistently when retried.
+
+    The time of the runs that timed out is not recorded, it is the timeout
+    and not what the test really takes.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        Loggable.__init__(self)
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.text_factory = str
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self.debug("Creating tests history in %s", path)
+            self._db.execute("DROP TABLE IF EXISTS tests")
+            self._db.execute("CREATE TABLE tests (classname TEXT PRIMARY KEY,"
+                             " total_time REAL, runs INTEGER,"
+                             " flaky_runs INTEGER, failed_runs INTEGER,"
+                             " timed_runs INTEGER, failed_streak INTEGER)")
+            self._db.execute("PRAGMA user_version = %d" % self.VERSION)
+            self._db.commit()
+
+    def get_times(self):
+        """
+        Returns: A dict of test classname -> mean time taken in seconds, for
+                 the tests that did not always time out
+        """
+        return dict((classname, total_time / timed_runs)
+                    for classname, total_time, timed_runs in self._db.execute(
+                        "SELECT classname, total_time, timed_runs FROM tests"
+                        " WHERE timed_runs > 0"))
+
+    def get_flakiness(self):
+        """
+        Returns: A dict of test classname -> (number of runs, number of runs
+                 where it passed after failing, number of runs where it
+                 failed every time it was retried, number of those in a row
+                 since it last passed)
+        """
+        return dict((row[0], row[1:]) for row in self._db.execute(
+            "SELECT classname, runs, flaky_runs, failed_runs, failed_streak"
+            " FROM tests"))
+
+    def add(self, test):
+        if test.result == Result.NOT_RUN or not test.time_taken:
+            return
+
+        flaky = failed = 0
+        timed = 1
+        time_taken = test.time_taken
+        if test.result == Result.TIMEOUT:
+            timed = 0
+            time_taken = 0
+        if test.failed_attempts:
+            if test.result == Result.PASSED:
+                flaky = 1
+            else:
+                failed = 1
+
+        self._db.execute("INSERT OR IGNORE INTO tests VALUES (?, 0, 0, 0, 0, 0, 0)",
+                         (test.classname, ))
+        # Failing without being retried neither breaks nor extends the streak
+        self._db.execute("UPDATE tests SET total_time = total_time + ?,"
+                         " runs = runs + 1, flaky_runs = flaky_runs + ?,"
+                         " failed_runs = failed_runs + ?, timed_runs = timed_runs + ?,"
+                         " failed_streak = CASE WHEN ? THEN failed_streak + 1"
+                         " WHEN ? THEN 0 ELSE failed_streak END"
+                         " WHERE classname = ?",
+                         (time_taken, flaky, failed, timed, failed,
+                          test.result == Result.PASSED, test.classname))
+        self._db.commit()
+
+
+class ResultsCache(Loggable):
+    """
+    Keeps the results of the tests that passed, so that they do not need to
+    run again as long as nothing they depend on changed.
+
+    Results are keyed on a digest of the test name, its command line, the
+    content of its input files (see Test.get_input_files), of the binary
+    running it, of the files matching options.cache_plugins (the GStreamer
+    plugins by default) and of the environment variables that change the
+    behaviour of GStreamer. The logs of the tests are copied next to the
+    database so that they are still around when a cached result is reported.
+    """
+    VERSION = 1
+    # Prefixes of the environment variables the results depend on
+    ENVIRONMENT = ["GST_", "GES_", "LD_LIBRARY_PATH", "DYLD_LIBRARY_PATH"]
+    PLUGINS_EXTENSIONS = (".so", ".dll", ".dylib")
+
+    def __init__(self, path, logsdir, options):
+        Loggable.__init__(self)
+        self.logsdir = logsdir
+        self.options = options
+        self.hits = 0
+        self.misses = 0
+        self._identities = {}
+        self._plugins_key = None
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.text_factory = str
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self.debug("Creating results cache in %s", path)
+            self._db.execute("DROP TABLE IF EXISTS results")
+            self._db.execute("DROP TABLE IF EXISTS files")
+            self._db.execute("CREATE TABLE results (key TEXT PRIMARY KEY,"
+                             " classname TEXT, result TEXT, message TEXT,"
+                             " time_taken REAL, properties TEXT, logs TEXT,"
+                             " size INTEGER, stored REAL)")
+            # Digests of the files we depend on, recomputed only when
+            # their size or modification time change
+            self._db.execute("CREATE TABLE files (path TEXT PRIMARY KEY,"
+                             " size INTEGER, mtime REAL, digest TEXT)")
+            self._db.execute("PRAGMA user_version = %d" % self.VERSION)
+            self._db.commit()
+
+    def _get_file_digest(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return "missing"
+
+        row = self._db.execute("SELECT size, mtime, digest FROM files"
+                               " WHERE path = ?", (path, )).fetchone()
+        if row is not None and tuple(row[:2]) == (stat.st_size, stat.st_mtime):
+            return row[2]
+
+        self.debug("Computing digest of %s", path)
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(utils.LOG_CHUNK_SIZE), ""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                         (path, stat.st_size, stat.st_mtime, digest))
+        self._db.commit()
+
+        return digest
+
+    def _get_files_key(self, paths):
+        return ["%s:%s" % (path, self._get_file_digest(path)) for path in paths]
+
+    def _get_application_identity(self, application):
+        try:
+            return self._identities[application]
+        except KeyError:
+            pass
+
+        try:
+            path = os.path.realpath(utils.which(application.split(" ")[0])[0])
+            identity = "%s:%s" % (application, self._get_file_digest(path))
+        except IndexError:
+            identity = application
+        self._identities[application] = identity
+
+        return identity
+
+    def _get_default_plugins(self):
+        """
+        Returns: The GStreamer plugins found in the directories GStreamer
+                 scans (recursively) for plugins
+        """
+        dirs = []
+        for var in ["GST_PLUGIN_PATH_1_0", "GST_PLUGIN_PATH",
+                    "GST_PLUGIN_SYSTEM_PATH_1_0", "GST_PLUGIN_SYSTEM_PATH"]:
+            dirs.extend(d for d in os.environ.get(var, "").split(os.pathsep) if d)
+
+        if "GST_PLUGIN_SYSTEM_PATH_1_0" not in os.environ and \
+                "GST_PLUGIN_SYSTEM_PATH" not in os.environ:
+            try:
+                dirs.append(subprocess.check_output(
+                    ["pkg-config", "--variable=pluginsdir", "gstreamer-1.0"]).strip())
+            except (OSError, subprocess.CalledProcessError) as e:
+                self.warning("Could not find the GStreamer plugins directory: %s", e)
+
+        plugins = set()
+        for d in dirs:
+            for root, subdirs, files in os.walk(os.path.expanduser(d)):
+                plugins.update(os.path.join(root, f) for f in files
+                               if f.endswith(self.PLUGINS_EXTENSIONS))
+
+        return plugins
+
+    def _get_plugins_key(self):
+        if self._plugins_key is None:
+            if self.options.cache_plugins:
+                paths = set()
+                for pattern in self.options.cache_plugins:
+                    paths.update(glob.glob(os.path.expanduser(pattern)))
+            else:
+                paths = self._get_default_plugins()
+            self._plugins_key = self._get_files_key(sorted(paths))
+            self._plugins_key.extend("%s=%s" % (var, value)
+                                     for var, value in sorted(os.environ.items())
+                                     if var.startswith(tuple(self.ENVIRONMENT)))
+
+        return self._plugins_key
+
+    def get_key(self, test):
+        # The port of our HTTP server can change between runs
+        command = test.build_command().replace(
+            "127.0.0.1:%s" % self.options.http_server_port, "HTTP_SERVER")
+        key = [test.classname, command,
+               self._get_application_identity(test.application)]
+        key.extend(self._get_files_key(test.get_input_files()))
+        key.extend(self._get_plugins_key())
+
+        return hashlib.sha1("\n".join(key)).hexdigest()
+
+    def _get_logs_dir(self, key):
+        return os.path.join(self.logsdir, key[:2], key)
+
+    def restore(self, test):
+        """
+        Sets the result of @test from the cache if it is in there, making
+        its logs point to the cached ones.
+
+        Returns: True if the result of @test comes from the cache
+        """
+        test.cache_key = self.get_key(test)
+        row = self._db.execute("SELECT result, message, time_taken, properties,"
+                               " logs FROM results WHERE key = ?",
+                               (test.cache_key, )).fetchone()
+        logs = [] if row is None else row[4].split("\n")
+        if not logs or not all(os.path.exists(log) for log in logs):
+            self.misses += 1
+            return False
+
+        self.debug("Using cached result for %s", test.classname)
+        self.hits += 1
+        properties = json.loads(row[3])
+        properties["cached"] = "true"
+        test.set_stored_result(row[0], row[1], row[2], properties,
+                               logs[0], logs[1:], "cached")
+
+        return True
+
+    def add(self, test):
+        # Flaky tests keep running
+        if test.restored or test.cache_key is None or \
+                test.result != Result.PASSED or test.failed_attempts:
+            return
+
+        logsdir = self._get_logs_dir(test.cache_key)
+        shutil.rmtree(logsdir, ignore_errors=True)
+        mkdir(logsdir)
+
+        # Keep the logs as they are reported
+        logs = [os.path.join(logsdir, os.path.basename(test.logfile))]
+        test.out.flush()
+        shutil.copyfile(test.logfile, logs[0])
+        for extralog in test.extra_logfiles:
+            logs.append(os.path.join(logsdir, os.path.basename(extralog)))
+            with open(logs[-1], 'w') as f:
+                for chunk in test.iter_extra_log_content(extralog):
+                    f.write(chunk)
+
+        self._db.execute("INSERT OR REPLACE INTO results VALUES"
+                         " (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (test.cache_key, test.classname, test.result,
+                          test.message, test.time_taken,
+                          json.dumps(test.properties), "\n".join(logs),
+                          sum(os.path.getsize(log) for log in logs),
+                          time.time()))
+        self._db.commit()
+
+    def _remove(self, key):
+        self._db.execute("DELETE FROM results WHERE key = ?", (key, ))
+        shutil.rmtree(self._get_logs_dir(key), ignore_errors=True)
+
+    def evict(self, max_age, max_size):
+        """
+        Removes the results stored more than @max_age days ago, and then the
+        oldest ones until their logs take less than @max_size MB.
+        """
+        size = 0
+        max_size *= 1024 * 1024
+        min_stored = time.time() - max_age * 24 * 3600
+        for key, entry_size, stored in self._db.execute(
+                "SELECT key, size, stored FROM results"
+                " ORDER BY stored DESC").fetchall():
+            size += entry_size
+            if stored < min_stored or size > max_size:
+                self._remove(key)
+        self._db.commit()
+
+
+class RunJournal(Loggable):
+    """
+    Append only journal of the tests that finished in a run, written as
+    they finish, so that the run can be resumed if it gets interrupted.
+    """
+
+    def __init__(self, path, resume):
+        Loggable.__init__(self)
+        self._records = {}
+        if resume:
+            self._records = self._load(path)
+            printc("Resuming run from %s: %d tests already finished"
+                   % (path, len(self._records)), Colors.OKBLUE)
+            self._file = open(path, 'a')
+        else:
+            self._file = open(path, 'w')
+
+    def _load(self, path):
+        records = {}
+        try:
+            f = open(path, 'r')
+        except IOError as e:
+            self.warning("Can not resume from %s: %s", path, e)
+            return records
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The run got interrupted while writing it
+                    continue
+                records[record["classname"].encode("utf-8")] = record
+
+        return records
+
+    def add(self, test):
+        record = {"classname": test.classname,
+                  "result": test.result,
+                  "message": test.message,
+                  "command": test.command,
+                  "time_taken": test.time_taken,
+                  "finished": time.time(),
+                  "properties": test.properties,
+                  "logfile": test.logfile,
+                  "extra_logfiles": test.extra_logfiles,
+                  "failed_attempts": test.failed_attempts}
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def restore(self, test):
+        """
+        Sets the result of @test from the journal if it finished in the run
+        being resumed.
+
+        Returns: True if @test finished in the run being resumed
+        """
+        record = self._records.pop(test.classname, None)
+        if record is None:
+            return False
+
+        utf8 = lambda string: string.encode("utf-8")
+        logfile = utf8(record["logfile"])
+        if not os.path.exists(logfile):
+            self.warning("Running %s again as its logs are gone", test.classname)
+            return False
+
+        test.set_stored_result(record["result"], record["message"],
+                               record["time_taken"], record["properties"],
+                               logfile, [utf8(log) for log in record["extra_logfiles"]],
+                               "resumed")
+        test.command = utf8(record["command"])
+        test.failed_attempts = [(str(result), message, utf8(log)) for result, message, log
+                                in record.get("failed_attempts", [])]
+
+        return True
+
+
 class _TestsLauncher(Loggable):
     def __init__(self):
 
@@ -554,6 +1397,12 @@ class _TestsLauncher(Loggable):
         self.testers = []
         self.tests = []
         self.reporter = None
+        self.history = None
+        self.results_cache = None
+        self.journal = None
+        self._flakiness = {}
+        # Maximum RSS of the tests in each --forever iteration
+        self._iterations_max_rss = {}
         self._list_testers()
         self.wanted_tests_patterns = []
 
@@ -579,6 +1428,16 @@ class _TestsLauncher(Loggable):
     def set_settings(self, options, args):
         self.reporter = reporters.XunitReporter(options)
         mkdir(options.logsdir)
+        mkdir(options.main_dir)
+        self.history = TestsHistory(os.path.join(options.main_dir,
+                                                 TESTS_HISTORY))
+        if options.use_cache:
+            self.results_cache = ResultsCache(os.path.join(options.main_dir,
+                                                           RESULTS_CACHE),
+                                              os.path.join(options.main_dir,
+                                                           RESULTS_CACHE_LOGS),
+                                              options)
+            self.results_cache.evict(options.cache_max_age, options.cache_max_size)
 
         self.options = options
         wanted_testers = None
@@ -600,28 +1459,315 @@ class _TestsLauncher(Loggable):
         for tester in self.testers:
             tester.list_tests()
             self.tests.extend(tester.tests)
+        self.tests = self._shard_tests(self.tests)
+
+        if self.options.rerun_tests is not None:
+            missing = self.options.rerun_tests - \
+                set(test.classname for test in self.tests)
+            if missing:
+                printc("Tests to rerun that do not exist anymore:\n  + %s"
+                       % "\n  + ".join(sorted(missing)), Colors.WARNING)
+
         return self.tests
 
-    def _run_tests(self):
-        cur_test_num = 0
-        total_num_tests = 0
-        for tester in self.testers:
-            total_num_tests += len(tester.list_tests())
+    def _stops_on_failure(self, test):
+        return test.result != Result.PASSED and (self.options.forever or
+                                                 self.options.fatal_error)
 
-        for tester in self.testers:
-            res = tester.run_tests(cur_test_num, total_num_tests)
-            cur_test_num += len(tester.list_tests())
-            if res != Result.PASSED and (self.options.forever or
-                    self.options.fatal_error):
+    def _restore_result(self, test):
+        if self.journal.restore(test):
+            return True
+
+        # Tests are run again and again in --forever mode, and their
+        # performance needs to be measured when benchmarking
+        if self.results_cache is not None and not self.options.forever and \
+                not self.options.benchmark and self.results_cache.restore(test):
+            self.journal.add(test)
+            return True
+
+        return False
+
+    def _check_iterations_growth(self, test):
+        """
+        Checks how the maximum memory used by @test grows over the --forever
+        iterations, failing it if it grows faster than
+        options.max_rss_growth_per_iteration.
+        """
+        if not self.options.forever or "max_rss_kb" not in test.properties:
+            return
+
+        max_rsss = self._iterations_max_rss.setdefault(test.classname, [])
+        max_rsss.append(test.properties["max_rss_kb"] * 1024)
+        if len(max_rsss) < MIN_GROWTH_SAMPLES:
+            return
+
+        growth = utils.get_slope(list(enumerate(max_rsss)))
+        test.properties["rss_growth_per_iteration"] = "%d" % growth
+        threshold = self.options.max_rss_growth_per_iteration
+        if threshold is not None and growth > threshold and \
+                test.result == Result.PASSED:
+            test.set_result(Result.FAILED,
+                            "Maximum memory grew by %d bytes per iteration over"
+                            " %d iterations (more than %d)"
+                            % (growth, len(max_rsss), threshold),
+                            "memory-growth")
+            printc("%s: %s (%s)" % (test.classname, test.result, test.message),
+                   color=utils.get_color_for_result(test.result))
+
+    def _test_finished(self, test):
+        self._check_iterations_growth(test)
+        self.journal.add(test)
+        self.history.add(test)
+        if self.results_cache is not None:
+            self.results_cache.add(test)
+
+    def _may_retry(self, test):
+        if test.result not in [Result.FAILED, Result.TIMEOUT]:
+            return False
+
+        if len(test.failed_attempts) >= self.options.retry_failed:
+            return False
+
+        # Fail fast if the test consistently failed in its last runs
+        runs, flaky_runs, failed_runs, failed_streak = \
+            self._flakiness.get(test.classname, (0, 0, 0, 0))
+        return failed_streak < RETRY_MAX_FAILED_RUNS
+
+    def _keep_attempt_logs(self, test):
+        """ Moves the logs of the attempt of @test that just failed away """
+        test.out.close()
+        attempt = len(test.failed_attempts) + 1
+        for log in [test.logfile] + test.extra_logfiles:
+            try:
+                os.rename(log, "%s.attempt%d" % (log, attempt))
+            except OSError:
+                pass
+
+        return "%s.attempt%d" % (test.logfile, attempt)
+
+    def _run_test(self, test):
+        """
+        Runs @test, running it again up to options.retry_failed times while it
+        fails to tell flaky tests from the ones that consistently fail.
+        """
+        test.run()
+        failed_attempts = []
+        while self._may_retry(test):
+            failed_attempts.append((test.result, test.message,
+                                    self._keep_attempt_logs(test)))
+            test.clean()
+            test.failed_attempts = failed_attempts
+            if test.verbose:
+                printc("Retrying %s (attempt %d of %d)" % (test.classname,
+                                                           len(failed_attempts) + 1,
+                                                           self.options.retry_failed + 1),
+                       Colors.WARNING)
+            self.reporter.before_test(test)
+            test.run()
+
+        if not failed_attempts:
+            return
+
+        test.properties["attempts"] = len(failed_attempts) + 1
+        test.properties["flaky"] = str(test.result == Result.PASSED).lower()
+        if test.result == Result.PASSED:
+            test.set_result(Result.PASSED, "Flaky: passed after failing %d times (%s)"
+                            % (len(failed_attempts),
+                               ", ".join(message or result for result, message, log
+                                         in failed_attempts)))
+
+    def _print_flaky_tests(self):
+        flaky_tests = [test for test in self.reporter.results
+                       if test.failed_attempts and test.result == Result.PASSED]
+        if not flaky_tests:
+            return
+
+        flakiness = self.history.get_flakiness()
+        message = "Flaky tests:"
+        for test in flaky_tests:
+            runs, flaky_runs, failed_runs, failed_streak = \
+                flakiness.get(test.classname, (0, 0, 0, 0))
+            message += "\n  + %s: %s\n    flaky in %d of %d runs, failed in %d" \
+                % (test.classname, test.message, flaky_runs, runs, failed_runs)
+            for result, msg, log in test.failed_attempts:
+                message += "\n    - %s" % log
+        printc(message, Colors.WARNING)
+
+    def _run_tests_serial(self, tests):
+        total_num_tests = len(tests)
+        for i, test in enumerate(tests):
+            sys.stdout.write("[%d / %d] " % (i + 1, total_num_tests))
+            if self._restore_result(test):
+                printc("%s: %s (%s)" % (test.classname, test.result, test.restored),
+                       color=utils.get_color_for_result(test.result))
+            else:
+                self.reporter.before_test(test)
+                self._run_test(test)
+                self._test_finished(test)
+            self.reporter.after_test(test)
+            if self._stops_on_failure(test):
                 return False
 
         return True
 
+    def _run_test_worker(self, jobs, finished):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+
+            i, test = job
+            try:
+                self._run_test(test)
+            except Exception as e:
+                self.warning("%s raised: %s" % (test.classname, e))
+                test.set_result(Result.FAILED, "Launcher error: %s" % e)
+
+            finished.put((i, test))
+
+    def _wait_finished_test(self, finished):
+        # Blocking forever on a Queue can not be interrupted by
+        # KeyboardInterrupt in python2, so wait with a timeout
+        while True:
+            try:
+                return finished.get(True, 1)
+            except Queue.Empty:
+                pass
+
+    def _run_tests_parallel(self, tests):
+        """
+        Runs up to options.num_jobs tests at once. Tests are started and
+        reported in the same order as in a serial run, so that the final
+        report does not depend on the number of jobs.
+        """
+        total_num_tests = len(tests)
+        jobs = Queue.Queue()
+        finished = Queue.Queue()
+        workers = []
+        for i in range(min(self.options.num_jobs, total_num_tests)):
+            worker = threading.Thread(target=self._run_test_worker,
+                                      args=(jobs, finished))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        running = {}
+        done = {}
+        next_test = 0
+        next_report = 0
+        stopping = False
+        res = True
+        try:
+            while running or (not stopping and next_test < total_num_tests):
+                while not stopping and next_test < total_num_tests and \
+                        len(running) < len(workers):
+                    test = tests[next_test]
+                    if self._restore_result(test):
+                        done[next_test] = test
+                    else:
+                        self.reporter.before_test(test)
+                        test.verbose = False
+                        running[next_test] = test
+                        jobs.put((next_test, test))
+                    next_test += 1
+
+                if running:
+                    i, test = self._wait_finished_test(finished)
+                    del running[i]
+                    done[i] = test
+                    if self._stops_on_failure(test):
+                        # Let the tests already running finish, but do not
+                        # start new ones
+                        stopping = True
+
+                while res and next_report in done:
+                    test = done.pop(next_report)
+                    next_report += 1
+                    # Only record the tests that get reported
+                    if not test.restored:
+                        self._test_finished(test)
+                    printc("[%d / %d] %s: %s%s" % (next_report, total_num_tests,
+                                                   test.classname, test.result,
+                                                   " (%s)" % test.restored if test.restored else ""),
+                           color=utils.get_color_for_result(test.result))
+                    self.reporter.after_test(test)
+                    if self._stops_on_failure(test):
+                        res = False
+        except KeyboardInterrupt:
+            for test in running.values():
+                try:
+                    test.process.send_signal(signal.SIGINT)
+                except (AttributeError, OSError):
+                    pass
+            raise
+        finally:
+            for worker in workers:
+                jobs.put(None)
+
+        # Tests that ran after the first failure in the serial order
+        # are not reported, the same way as in a serial run
+        for test in done.values():
+            self.reporter.discard_test(test)
+
+        return res
+
+    def _shard_tests(self, tests):
+        """
+        Returns the part of @tests that belongs to the shard selected with
+        --shard. Tests are spread over the shards so that they all have about
+        the same expected duration to run. Only the expected durations of the
+        tests are used (and not the local history) so that every machine
+        computes the same partition.
+        """
+        if self.options.shard is None:
+            return tests
+
+        index, count = self.options.shard
+        loads = [0] * count
+        shards = [[] for i in range(count)]
+        for test in sorted(tests, key=lambda test: (-test.duration,
+                                                    test.classname)):
+            shard = loads.index(min(loads))
+            loads[shard] += test.duration + SHARD_TEST_OVERHEAD
+            shards[shard].append(test)
+
+        return shards[index - 1]
+
+    def _sort_tests(self, tests):
+        """
+        Sorts @tests so that the ones expected to take the longest run
+        first, using the time they took in previous runs or, for tests
+        that never ran, their expected duration. Ties are broken on the
+        test name so that the order is reproducible.
+        """
+        times = self.history.get_times()
+
+        def expected_time(test):
+            return times.get(test.classname, test.duration)
+
+        return sorted(tests, key=lambda test: (-expected_time(test),
+                                               test.classname))
+
+    def _run_tests(self):
+        tests = []
+        for tester in self.testers:
+            tests.extend(tester.list_tests())
+        tests = self._sort_tests(self._shard_tests(tests))
+        self._flakiness = self.history.get_flakiness()
+
+        if self.options.num_jobs > 1:
+            return self._run_tests_parallel(tests)
+
+        return self._run_tests_serial(tests)
+
     def _clean_tests(self):
         for tester in self.testers:
             tester.clean_tests()
 
     def run_tests(self):
+        self.journal = RunJournal(os.path.join(self.options.logsdir,
+                                               RUN_JOURNAL),
+                                  self.options.resume)
         if self.options.forever:
             while self._run_tests():
                 self._clean_tests()
@@ -630,8 +1776,80 @@ class _TestsLauncher(Loggable):
         else:
             return self._run_tests()
 
+    def _print_benchmark(self):
+        message = ""
+        for test in self.reporter.results:
+            figures = ["%s: %s" % (name.replace("benchmark_", "", 1), value)
+                       for name, value in sorted(test.properties.items())
+                       if name.startswith("benchmark_")]
+            if figures:
+                message += "\n  + %s:\n      %s" % (test.classname,
+                                                  "\n      ".join(figures))
+
+        if message:
+            printc("Benchmark:" + message, Colors.OKBLUE)
+
+        for name, title, fmt in BENCHMARK_TABLES:
+            self._print_benchmark_table(name, title, fmt)
+
+    def _save_benchmark_baseline(self, path):
+        """
+        Writes the benchmark figures of the tests that passed to @path,
+        keeping the ones of the other tests already there
+        """
+        try:
+            with open(path) as f:
+                baseline = json.load(f)
+        except (IOError, ValueError):
+            baseline = {}
+
+        for test in self.reporter.results:
+            figures = dict((name, value) for name, value in test.properties.items()
+                           if name.startswith("benchmark_"))
+            if figures and test.result == Result.PASSED:
+                baseline[test.classname] = figures
+
+        with open(path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True, separators=(",", ": "))
+        printc("Benchmark baseline saved to %s" % path, Colors.OKBLUE)
+
+    def _print_benchmark_table(self, name, title, fmt):
+        values = {}
+        for test in self.reporter.results:
+            if test.benchmark_group is not None and name in test.properties:
+                values.setdefault(test.benchmark_group, []).append(
+                    float(test.properties[name]))
+
+        if not values:
+            return
+
+        rows = sorted(set(row for row, column in values))
+        columns = sorted(set(column for row, column in values))
+        table = [[""] + columns]
+        for row in rows:
+            table.append([row] + [fmt % utils.get_percentile(values[(row, column)], 50)
+                                  if (row, column) in values else "-"
+                                  for column in columns])
+
+        widths = [max(len(line[i]) for line in table)
+                  for i in range(len(columns) + 1)]
+        message = "\n".join("  " + "  ".join(cell.rjust(width) if i else cell.ljust(width)
+                                              for i, (cell, width) in enumerate(zip(line, widths)))
+                            for line in table)
+        printc("%s:\n%s" % (title, message), Colors.OKBLUE)
+
     def final_report(self):
         self.reporter.final_report()
+        self._print_flaky_tests()
+        if self.options.benchmark:
+            self._print_benchmark()
+        if self.options.save_benchmark_baseline:
+            self._save_benchmark_baseline(self.options.save_benchmark_baseline)
+        if self.results_cache is not None and \
+                (self.results_cache.hits or self.results_cache.misses):
+            printc("Results cache: %d hits, %d misses"
+                   % (self.results_cache.hits, self.results_cache.misses),
+                   Colors.OKBLUE)
 
     def needs_http_server(self):
         for tester in self.testers:
@@ -695,6 +1913,46 @@ class Scenario(object):
             return 0
 
 
+class ScenariosCache(Loggable):
+    """
+    On disk cache of scenario definitions, so that we do not need to run
+    gst-validate to discover scenarios that did not change.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        Loggable.__init__(self)
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.text_factory = str
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self.debug("Creating scenarios cache in %s", path)
+            self._db.execute("DROP TABLE IF EXISTS scenarios")
+            self._db.execute("CREATE TABLE scenarios (key TEXT PRIMARY KEY,"
+                             " definitions TEXT)")
+            self._db.execute("PRAGMA user_version = %d" % self.VERSION)
+            self._db.commit()
+
+    def get(self, key):
+        """
+        Returns: The list of (scenario name, definition items) stored for
+                 @key, or None
+        """
+        row = self._db.execute("SELECT definitions FROM scenarios WHERE key = ?",
+                               (key, )).fetchone()
+        if row is None:
+            return None
+
+        # json gives us back unicode strings, ConfigParser gave us utf-8 ones
+        utf8 = lambda string: string.encode("utf-8")
+        return [(utf8(name), [(utf8(prop), utf8(value)) for prop, value in items])
+                for name, items in json.loads(row[0])]
+
+    def set(self, key, definitions):
+        self._db.execute("INSERT OR REPLACE INTO scenarios VALUES (?, ?)",
+                         (key, json.dumps(definitions)))
+        self._db.commit()
+
+
 class ScenarioManager(Loggable):
     _instance = None
     all_scenarios = []
@@ -710,11 +1968,13 @@ class ScenarioManager(Loggable):
                                 cls, *args, **kwargs)
             cls._instance.config = None
             cls._instance.discovered = False
+            cls._instance._cache = None
+            cls._instance._gst_validate_identity = None
             Loggable.__init__(cls._instance)
 
         return cls._instance
 
-    def find_special_scenarios(self, mfile):
+    def find_special_scenarios_files(self, mfile):
         scenarios = []
         mfile_bname = os.path.basename(mfile)
         for f in os.listdir(os.path.dirname(mfile)):
@@ -722,51 +1982,194 @@ class ScenarioManager(Loggable):
                           f):
                 scenarios.append(os.path.join(os.path.dirname(mfile), f))
 
-        if scenarios:
-            scenarios = self.discover_scenarios(scenarios, mfile)
+        return scenarios
 
+    def _get_cache(self):
+        if self._cache is None:
+            self._cache = ScenariosCache(os.path.join(self.config.main_dir,
+                                                      SCENARIOS_CACHE))
 
-        return scenarios
+        return self._cache
 
-    def discover_scenarios(self, scenario_paths=[], mfile=None):
+    def _get_gst_validate_identity(self):
+        if self._gst_validate_identity is None:
+            try:
+                path = os.path.realpath(utils.which(self.GST_VALIDATE_COMMAND)[0])
+                self._gst_validate_identity = "%s:%d:%f" % (
+                    path, os.path.getsize(path), os.path.getmtime(path))
+            except (IndexError, OSError):
+                self._gst_validate_identity = self.GST_VALIDATE_COMMAND
+
+        return self._gst_validate_identity
+
+    def _get_files_identity(self, paths):
+        identity = []
+        for path in paths:
+            try:
+                identity.append("%s:%d:%f" % (path, os.path.getsize(path),
+                                              os.path.getmtime(path)))
+            except OSError:
+                identity.append("%s:missing" % path)
+
+        return identity
+
+    def _get_default_scenarios_dirs(self):
         """
-        Discover scenarios specified in scenario_paths or the default ones
-        if nothing specified there
+        Returns: The places where gst-validate looks for the default
+                 scenarios, see gst_validate_list_scenarios
+        """
+        gst_validate = utils.which(self.GST_VALIDATE_COMMAND)
+        prefix = ""
+        if gst_validate:
+            prefix = os.path.dirname(os.path.dirname(os.path.realpath(gst_validate[0])))
+
+        data_home = os.environ.get("XDG_DATA_HOME",
+                                   os.path.expanduser(os.path.join("~", ".local", "share")))
+        dirs = [os.path.join(data_home, "gstreamer-1.0", "validate-scenario"),
+                os.path.join(prefix, "share", "gstreamer-1.0", "validate-scenario")]
+        envvar = os.environ.get("GST_VALIDATE_SCENARIOS_PATH")
+        if envvar:
+            dirs.extend(envvar.split(":"))
+        # gst-validate also looks into data/ to work uninstalled
+        dirs.append(os.path.abspath("data"))
+
+        return dirs
+
+    def _get_default_scenarios_key(self):
+        """ Identifies the default scenarios """
+        key = [self._get_gst_validate_identity()]
+        for d in self._get_default_scenarios_dirs():
+            try:
+                files = [os.path.join(d, f) for f in sorted(os.listdir(d))
+                         if f.endswith("." + self.FILE_EXTENDION)]
+            except OSError:
+                files = []
+            key.append(d)
+            key.extend(self._get_files_identity(files))
+
+        return "\n".join(key)
+
+    def _get_scenario_file_key(self, path):
+        return "\n".join([self._get_gst_validate_identity()] +
+                         self._get_files_identity([path]))
+
+    def _run_discovery(self, scenario_paths):
+        """
+        Runs gst-validate to get the definitions of the scenarios in
+        @scenario_paths, or of the default ones if empty.
+
+        Returns: The list of (scenario name, definition items), or None if
+                 gst-validate failed
         """
-        scenarios = []
         scenario_defs = os.path.join(self.config.main_dir, "scenarios.def")
+        # Never read the definitions of a previous discovery
+        try:
+            os.remove(scenario_defs)
+        except OSError:
+            pass
+
         logs = open(os.path.join(self.config.logsdir, "scenarios_discovery.log"), 'w')
         try:
             command = [self.GST_VALIDATE_COMMAND, "--scenarios-defs-output-file", scenario_defs]
             command.extend(scenario_paths)
             subprocess.check_call(command, stdout=logs, stderr=logs)
-        except subprocess.CalledProcessError:
-            pass
 
-        config = ConfigParser.ConfigParser()
-        f = open(scenario_defs)
-        config.readfp(f)
-
-        for section in config.sections():
-            if scenario_paths:
-                for scenario_path in scenario_paths:
-                    if section in scenario_path:
-                        # The real name of the scenario is:
-                        # filename.REALNAME.scenario
-                        name = scenario_path.replace(mfile + ".", "").replace("." + self.FILE_EXTENDION, "")
-                        path = scenario_path
+            config = ConfigParser.ConfigParser()
+            with open(scenario_defs) as f:
+                config.readfp(f)
+        except (subprocess.CalledProcessError, OSError, IOError,
+                ConfigParser.Error) as e:
+            self.warning("Could not discover scenarios %s: %s (see %s)",
+                         scenario_paths, e, logs.name)
+            return None
+        finally:
+            logs.close()
+
+        return [(section, config.items(section)) for section in config.sections()]
+
+    def cache_scenarios(self, scenario_paths):
+        """
+        Discovers, with as few gst-validate runs as possible, the scenarios
+        in @scenario_paths that have not been cached yet.
+        """
+        cache = self._get_cache()
+        missing = [path for path in set(scenario_paths)
+                   if cache.get(self._get_scenario_file_key(path)) is None]
+
+        # Scenarios are identified by their file name in gst-validate
+        # output, so we can only discover files with different names at once
+        while missing:
+            batch = {}
+            for path in sorted(missing):
+                batch.setdefault(os.path.basename(path), path)
+            missing = [path for path in missing if path not in batch.values()]
+
+            self.debug("Discovering scenarios: %s", batch.values())
+            definitions = self._run_discovery(batch.values())
+            if definitions is None:
+                continue
+
+            definitions = dict(definitions)
+            for bname, path in batch.iteritems():
+                section = bname.replace("." + self.FILE_EXTENDION, "")
+                try:
+                    cache.set(self._get_scenario_file_key(path),
+                              [(section, definitions[section])])
+                except KeyError:
+                    self.warning("Could not discover scenario: %s" % path)
+
+    def discover_scenarios(self, scenario_paths=[], mfile=None):
+        """
+        Discover scenarios specified in scenario_paths or the default ones
+        if nothing specified there
+        """
+        scenarios = []
+        cache = self._get_cache()
+        if scenario_paths:
+            self.cache_scenarios(scenario_paths)
+            for scenario_path in scenario_paths:
+                definitions = cache.get(self._get_scenario_file_key(scenario_path))
+                if definitions is None:
+                    continue
+
+                # The real name of the scenario is:
+                # filename.REALNAME.scenario
+                name = scenario_path.replace(mfile + ".", "").replace("." + self.FILE_EXTENDION, "")
+                scenarios.append(Scenario(name, definitions[0][1], scenario_path))
+
+            return scenarios
+
+        key = self._get_default_scenarios_key()
+        definitions = cache.get(key)
+        if definitions is None:
+            definitions = self._run_discovery([])
+            if definitions is None:
+                definitions = []
             else:
-                name = section
-                path = None
+                cache.set(key, definitions)
 
-            scenarios.append(Scenario(name, config.items(section), path))
+        for section, items in definitions:
+            scenarios.append(Scenario(section, items))
 
-        if not scenario_paths:
-            self.discovered = True
-            self.all_scenarios.extend(scenarios)
+        self.discovered = True
+        self.all_scenarios.extend(scenarios)
 
         return scenarios
 
+    def find_scenario_file(self, scenario):
+        """
+        Returns: The path of the file defining @scenario, or None
+        """
+        if scenario.path is not None:
+            return scenario.path
+
+        for d in self._get_default_scenarios_dirs():
+            path = os.path.join(d, "%s.%s" % (scenario.name, self.FILE_EXTENDION))
+            if os.path.isfile(path):
+                return path
+
+        return None
+
     def get_scenario(self, name):
         if self.discovered is False:
             self.discover_scenarios()
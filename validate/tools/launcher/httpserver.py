@@ -19,83 +19,160 @@
 
 import os
 import time
+import socket
 import loggable
+import threading
 import subprocess
 import sys
 
+import RangeHTTPServer
+
 logcat = "httpserver"
 
 
 class HTTPServer(loggable.Loggable):
-    """ Class to run a SimpleHttpServer in a process."""
+    """ Class to run a RangeHTTPServer in a thread or in a process."""
     def __init__(self, options):
         loggable.Loggable.__init__(self)
         self.options = options
         self._process = None
+        self._server = None
+        self._thread = None
         self._logsfile = None
 
     def _check_is_up(self, timeout=60):
-        """ Check if the server is up, running a simple test based on wget. """
+        """ Check if the server is up, trying to connect to it. """
         start = time.time()
         while True:
             try:
-                subprocess.check_output(["wget", "127.0.0.1:%s" %
-                                         (self.options.http_server_port),
-                                         "-O", os.devnull],
-                                        stderr=self._logsfile)
+                socket.create_connection(("127.0.0.1",
+                                          self.options.http_server_port),
+                                         1).close()
                 return True
-            except subprocess.CalledProcessError:
+            except socket.error:
                 pass
 
             if time.time() - start > timeout:
                 return False
 
-            time.sleep(1)
+            time.sleep(0.05)
 
-    def start(self):
+    def bind(self):
+        """
+        Create the server of the launcher, without serving yet, so that the
+        port the system chooses when options.http_server_port is 0 is
+        known before the tests are listed.
+        """
+        if self._server is not None:
+            return True
+
+        try:
+            self._server = RangeHTTPServer.ThreadingHTTPServer(
+                ("", self.options.http_server_port),
+                RangeHTTPServer.RangeHTTPRequestHandler)
+        except socket.error as ex:
+            self.warning("Could not launch server %s", ex)
+            return False
+
+        # The port might have been chosen by the system
+        self.options.http_server_port = self._server.server_address[1]
+
+        return True
+
+    def _start_in_process(self):
+        """ Start the server in a thread of the launcher """
+        self.debug("Launching server thread")
+        if not self.bind():
+            return False
+
+        self._server.directory = os.path.abspath(self.options.http_server_dir)
+        self._server.logfile = self._logsfile
+
+        # The server socket is listening, so the server is ready
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return True
+
+    def _start_process(self):
         """ Start the server in a subprocess """
+        try:
+            cmd = [sys.executable, os.path.join(os.path.dirname(__file__),
+                                                "RangeHTTPServer.py"),
+                   str(self.options.http_server_port)]
+            self.debug("Launching server: %s", cmd)
+            self._process = subprocess.Popen(cmd,
+                                             cwd=self.options.http_server_dir,
+                                             stderr=self._logsfile,
+                                             stdout=self._logsfile)
+            self.debug("Launched server")
+
+            if self._check_is_up():
+                return True
+
+            self._process.terminate()
+            self._process = None
+        except OSError as ex:
+            self.warning("Could not launch server %s", ex)
+
+        return False
+
+    def start(self):
+        """ Start the server, unless it is already running """
         self._logsfile = open(os.path.join(self.options.logsdir,
                                            "httpserver.logs"),
                               'w+')
         if self.options.http_server_dir is not None:
-            if self._check_is_up(timeout=2):
+            if self._server is None and self.options.http_server_port and \
+                    self._check_is_up(timeout=0):
                 return True
 
             print "Starting Server"
-            try:
-                self.debug("Lunching twistd server")
-                cmd = "%s %s %d" % (sys.executable, os.path.join(os.path.dirname(__file__),
-                                                     "RangeHTTPServer.py"),
-                                        self.options.http_server_port)
-                curdir = os.path.abspath(os.curdir)
-                os.chdir(self.options.http_server_dir)
-                #cmd = "twistd -no web --path=%s -p %d" % (
-                #    self.options.http_server_dir, self.options.http_server_port)
-                self.debug("Lunching server: %s", cmd)
-                self._process = subprocess.Popen(cmd.split(" "),
-                                                 stderr=self._logsfile,
-                                                 stdout=self._logsfile)
-                os.chdir(curdir)
-                self.debug("Lunched twistd server")
-                # Dirty way to avoid eating to much CPU...
-                # good enough for us anyway.
-                time.sleep(1)
-
-                if self._check_is_up():
-                    print "Started"
-                    return True
-                else:
-                    print "Failed starting server"
-                    self._process.terminate()
-                    self._process = None
-            except OSError as ex:
-                print "Failed starting server"
-                self.warning(logcat, "Could not launch server %s" % ex)
+            # Only a server in the launcher can tell us which port
+            # the system chose
+            if self.options.http_server_in_process or self._server or \
+                    not self.options.http_server_port:
+                started = self._start_in_process()
+            else:
+                started = self._start_process()
+
+            if started:
+                print "Started on port %d" % self.options.http_server_port
+                return True
+
+            print "Failed starting server"
 
         return False
 
+    def is_in_process(self):
+        """ Whether the server runs in a thread of the launcher """
+        return self._thread is not None
+
+    def wait(self):
+        """ Keep the server running until the user interrupts us. """
+        try:
+            if self._thread:
+                # Joining with a timeout so we can be interrupted
+                while self._thread.is_alive():
+                    self._thread.join(1)
+            elif self._process:
+                self._process.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
     def stop(self):
-        """ Stop the server subprocess if running. """
+        """ Stop the server if running. """
+        if self._server:
+            if self._thread:
+                self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
+            self.debug("Server stoped")
+
         if self._process:
             self._process.terminate()
             self._process = None
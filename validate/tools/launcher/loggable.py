@@ -26,6 +26,9 @@ import time
 import types
 import traceback
 import thread
+import threading
+import atexit
+import Queue
 
 
 # environment variables controlling levels for each category
@@ -37,6 +40,11 @@ _PACKAGE_SCRUB_LIST = []
 
 # dynamic dictionary of categories already seen and their level
 _categories = {}
+# cache of the highest level for which logging in a category can not be
+# shortcut, taking the registered handlers into account
+_shortcut_levels = {}
+# cache of the scrubbed filenames of code objects, None for this module
+_code_filenames = {}
 
 # log handlers registered
 _log_handlers = []
@@ -345,6 +353,7 @@ def registerCategory(category):
                 level = 5
     # store it
     _categories[category] = level
+    _shortcut_levels.clear()
 
 
 def getCategoryLevel(category):
@@ -378,6 +387,7 @@ def setLogSettings(state):
 
     for category in _categories:
         registerCategory(category)
+    _shortcut_levels.clear()
 
 
 def getLogSettings():
@@ -392,13 +402,23 @@ def getLogSettings():
             _log_handlers_limited)
 
 
-def _canShortcutLogging(category, level):
+def _getShortcutLevel(category):
     if _log_handlers:
         # we have some loggers operating without filters, have to do
         # everything
-        return False
+        shortcutLevel = LOG
     else:
-        return level > getCategoryLevel(category)
+        shortcutLevel = getCategoryLevel(category)
+
+    _shortcut_levels[category] = shortcutLevel
+    return shortcutLevel
+
+
+def _canShortcutLogging(category, level):
+    try:
+        return level > _shortcut_levels[category]
+    except KeyError:
+        return level > _getShortcutLevel(category)
 
 
 def scrubFilename(filename):
@@ -414,6 +434,23 @@ def scrubFilename(filename):
     return filename
 
 
+def _getCodeFilename(co):
+    """
+    Return the scrubbed filename of the given code object, or None if it
+    is part of this module.
+    """
+    try:
+        return _code_filenames[co]
+    except KeyError:
+        if co.co_filename.endswith('loggable.py'):
+            filename = None
+        else:
+            filename = scrubFilename(co.co_filename)
+        _code_filenames[co] = filename
+
+        return filename
+
+
 def getFileLine(where=-1):
     """
     Return the filename and line number for the given location.
@@ -444,7 +481,7 @@ def getFileLine(where=-1):
         stackFrame = sys._getframe()
         while stackFrame:
             co = stackFrame.f_code
-            if not co.co_filename.endswith('loggable.py'):
+            if _getCodeFilename(co) is not None:
                 # wind up the stack according to frame
                 while where < -1:
                     stackFrame = stackFrame.f_back
@@ -458,7 +495,7 @@ def getFileLine(where=-1):
     if not co:
         return "<unknown file>", 0
 
-    return scrubFilename(co.co_filename), lineno, name
+    return _getCodeFilename(co) or scrubFilename(co.co_filename), lineno, name
 
 
 def ellipsize(o):
@@ -513,6 +550,10 @@ def doLog(level, object, category, format, args, where=-1, filePath=None, line=N
     """
     ret = {}
 
+    # do not format the message if nothing is going to be logged
+    if _canShortcutLogging(category, level):
+        return ret
+
     if args:
         message = format % args
     else:
@@ -623,18 +664,8 @@ def safeprintf(file, format, *args):
         # otherwise ignore it, there's nothing you can do
 
 
-def stderrHandler(level, object, category, file, line, message):
-    """
-    A log handler that writes to stderr.
-    The output will be different depending the value of "_enableCrackOutput";
-    in Pitivi's case, that is True when the GST_DEBUG env var is defined.
-
-    @type level:    string
-    @type object:   string (or None)
-    @type category: string
-    @type message:  string
-    """
-
+def _formatStderrMessage(level, object, category, file, line, message,
+                         created, ident):
     # Make the file path more compact for readability
     file = os.path.relpath(file)
     where = "(%s:%d)" % (file, line)
@@ -642,22 +673,136 @@ def stderrHandler(level, object, category, file, line, message):
     # If GST_DEBUG is not set, we can assume only PITIVI_DEBUG is set, so don't
     # show a bazillion of debug details that are not relevant to Pitivi.
     if not _enableCrackOutput:
-        safeprintf(sys.stderr, '%s %-8s %-17s %-2s %s %s\n',
-               getFormattedLevelName(level), time.strftime("%H:%M:%S"),
-               category, "", message, where)
+        return '%s %-8s %-17s %-2s %s %s\n' % (
+            getFormattedLevelName(level),
+            time.strftime("%H:%M:%S", time.localtime(created)),
+            category, "", message, where)
     else:
         o = ""
         if object:
             o = '"' + object + '"'
         # level   pid     object   cat      time
         # 5 + 1 + 7 + 1 + 32 + 1 + 17 + 1 + 15 == 80
-        safeprintf(sys.stderr, '%s [%5d] [0x%12x] %-32s %-17s %-15s %-4s %s %s\n',
-                   getFormattedLevelName(level), os.getpid(), thread.get_ident(),
-                   o[:32], category, time.strftime("%b %d %H:%M:%S"), "",
-                   message, where)
+        return '%s [%5d] [0x%12x] %-32s %-17s %-15s %-4s %s %s\n' % (
+            getFormattedLevelName(level), os.getpid(), ident,
+            o[:32], category,
+            time.strftime("%b %d %H:%M:%S", time.localtime(created)), "",
+            message, where)
+
+
+def stderrHandler(level, object, category, file, line, message):
+    """
+    A log handler that writes to stderr.
+    The output will be different depending the value of "_enableCrackOutput";
+    in Pitivi's case, that is True when the GST_DEBUG env var is defined.
+
+    @type level:    string
+    @type object:   string (or None)
+    @type category: string
+    @type message:  string
+    """
+    safeprintf(sys.stderr, _formatStderrMessage(level, object, category,
+                                                file, line, message,
+                                                time.time(), thread.get_ident()))
     sys.stderr.flush()
 
 
+class AsyncStderrHandler(object):
+    """
+    A log handler that writes to stderr the same way as L{stderrHandler},
+    but from a separate thread, so that logging does not slow down the
+    threads emitting messages.
+
+    Messages are kept in a queue of at most maxsize messages, and written
+    in batches of at most batchSize messages, flushing stderr once per
+    batch. When the queue is full, new messages are dropped right away if
+    dropOnOverflow is True. Otherwise, and always for warnings and errors,
+    the logging thread waits for up to timeout seconds for the queue to
+    have some room, and drops the message if it is still full. The number
+    of dropped messages, counting the ones that could not be formatted or
+    written, is logged.
+
+    Pending messages are written when the interpreter exits, or when
+    L{flush} is called, waiting for at most timeout seconds.
+
+    It can be registered with L{addLimitedLogHandler} or L{addLogHandler}.
+    """
+
+    def __init__(self, maxsize=10000, batchSize=500, dropOnOverflow=True,
+                 timeout=5.0):
+        self._queue = Queue.Queue(maxsize)
+        self._batchSize = batchSize
+        self._dropOnOverflow = dropOnOverflow
+        self._timeout = timeout
+        self._dropped = 0
+        self._droppedLock = threading.Lock()
+
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def __call__(self, level, object, category, file, line, message):
+        record = (level, object, category, file, line, message, time.time(),
+                  thread.get_ident())
+        try:
+            self._queue.put(record, level <= WARN or not self._dropOnOverflow,
+                            self._timeout)
+        except Queue.Full:
+            with self._droppedLock:
+                self._dropped += 1
+
+    def _write(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < self._batchSize:
+                    records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            try:
+                messages = [_formatStderrMessage(*record) for record in records]
+                messages.append(self._getDroppedMessage())
+                safeprintf(sys.stderr, "".join(messages))
+                sys.stderr.flush()
+            except Exception:
+                # Keep on writing the next messages, and do not let the
+                # threads logging or flushing wait for those forever
+                with self._droppedLock:
+                    self._dropped += len(records)
+            finally:
+                for record in records:
+                    self._queue.task_done()
+
+    def _getDroppedMessage(self):
+        with self._droppedLock:
+            dropped, self._dropped = self._dropped, 0
+
+        if not dropped:
+            return ""
+
+        return "%s %d log messages dropped\n" % (getFormattedLevelName(WARN),
+                                                 dropped)
+
+    def flush(self):
+        """
+        Wait for all the messages logged so far to be written, for at most
+        the timeout given at construction.
+        """
+        # Queue.join() can not time out
+        deadline = time.time() + self._timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+
+        safeprintf(sys.stderr, self._getDroppedMessage())
+        sys.stderr.flush()
+
+
 def _preformatLevels(noColorEnvVarName):
     format = '%-5s'
 
@@ -679,11 +824,15 @@ def _preformatLevels(noColorEnvVarName):
 # setup functions
 
 
-def init(envVarName, enableColorOutput=False, enableCrackOutput=True):
+def init(envVarName, enableColorOutput=False, enableCrackOutput=True,
+         asyncOutput=False):
     """
     Initialize the logging system and parse the environment variable
     of the given name.
     Needs to be called before starting the actual application.
+
+    If asyncOutput is True, messages are written to stderr from a separate
+    thread using an L{AsyncStderrHandler}.
     """
     global _initialized
     global _enableCrackOutput
@@ -703,7 +852,10 @@ def init(envVarName, enableColorOutput=False, enableCrackOutput=True):
     if envVarName in os.environ:
         # install a log handler that uses the value of the environment var
         setDebug(os.environ[envVarName])
-    addLimitedLogHandler(stderrHandler)
+    if asyncOutput:
+        addLimitedLogHandler(AsyncStderrHandler())
+    else:
+        addLimitedLogHandler(stderrHandler)
 
     _initialized = True
 
@@ -741,6 +893,7 @@ def setPackageScrubList(*packages):
     """
     global _PACKAGE_SCRUB_LIST
     _PACKAGE_SCRUB_LIST = packages
+    _code_filenames.clear()
 
 
 def reset():
@@ -751,6 +904,7 @@ def reset():
 
     _log_handlers = []
     _log_handlers_limited = []
+    _shortcut_levels.clear()
     _initialized = False
 
 
@@ -772,6 +926,7 @@ def addLogHandler(func):
 
     if func not in _log_handlers:
         _log_handlers.append(func)
+        _shortcut_levels.clear()
 
 
 def addLimitedLogHandler(func):
@@ -806,6 +961,7 @@ def removeLogHandler(func):
     @raises ValueError: if func is not registered
     """
     _log_handlers.remove(func)
+    _shortcut_levels.clear()
 
 
 def removeLimitedLogHandler(func):
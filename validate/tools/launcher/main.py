@@ -18,6 +18,7 @@
 # Boston, MA 02110-1301, USA.
 import os
 import sys
+import json
 import utils
 import urlparse
 import loggable
@@ -26,8 +27,9 @@ import textwrap
 import reporters
 
 
+import RangeHTTPServer
 from httpserver import HTTPServer
-from baseclasses import _TestsLauncher, ScenarioManager
+from baseclasses import _TestsLauncher, ScenarioManager, RETRY_MAX_FAILED_RUNS
 from utils import printc, path2url, DEFAULT_MAIN_DIR, DEFAULT_GST_QA_ASSETS, launch_command, Colors, Protocols
 
 
@@ -114,6 +116,16 @@ You can generate such a file doing:
 Once this is done, gst-validate-launcher will run the scenarios on those media files the
 same way as if they were local files.
 
+The media served by the HTTP server of gst-validate-launcher can also be played
+under emulated network conditions (limited bandwidth, latency, jitter, stalls and
+dropped connections) using --network-profile, for example:
+
+.   $gst-validate-launch --network-profile regular_3g --network-profile stalling
+
+That runs the playback tests of those media (HLS streams included, to test variant
+switching) once more for each profile, the profile name being part of the test names
+(for example validate.http.regular_3g.playback... or validate.hls.stalling.playback...).
+
 
 4. Debug gst-validate-launcher execution
 ----------------------------------------
@@ -121,6 +133,76 @@ same way as if they were local files.
 You can activate debug logs setting the environment variable GST_VALIDATE_LAUNCHER_DEBUG.
 It uses the same synthax as PITIVI_DEBUG (more information at:
 http://wiki.pitivi.org/wiki/Bug_reporting#Debug_logs).
+When logging a lot, set GST_VALIDATE_LAUNCHER_DEBUG_ASYNC=1 to write the logs from a
+separate thread so that they slow the launcher down less (messages may then get dropped
+when they are logged faster than they can be written).
+
+5. Split a test run across several machines
+-------------------------------------------
+
+The --shard INDEX/COUNT argument makes gst-validate-launcher run only one part
+of the tests, so that COUNT machines can each run the shards from 1 to COUNT.
+Tests are spread between the shards so that they take about the same time to run,
+and every machine computes the same split as long as they use the same assets.
+
+The xunit files of each shard can then be merged into one report doing:
+
+.   $gst-validate-launch --merge-xunit shard1.xml --merge-xunit shard2.xml --xunit-file merged.xml
+
+6. Cache of test results
+------------------------
+
+With --cache, the results of the tests that passed are cached in MAIN_DIR, along with
+their logs, and those tests are not run again as long as their command line, their
+media files, media_info files and scenario files, the gst-validate or ges-launch
+binaries, the GStreamer plugins and the GST_*, GES_* and library path environment
+variables did not change.
+
+The plugins are looked for in GST_PLUGIN_PATH and in GST_PLUGIN_SYSTEM_PATH (or the
+plugins directory of GStreamer), computing the digest of all of them the first time
+takes a while. The plugins to take into account can be given with --cache-plugins
+instead, for example:
+
+.   $gst-validate-launch --cache --cache-plugins '/path/to/gst-plugins-good/gst/*/.libs/*.so'
+
+The digests of the media files are computed for each run using the cache, and are
+themselves cached as long as the size and modification time of the files do not change.
+
+7. Resume an interrupted run
+----------------------------
+
+Each test that finishes is recorded in LOGSDIR/run_journal.jsonl. If a run gets
+interrupted, running the same command with --resume runs the tests that did not finish,
+and the final report and xunit file include the results of the ones that did.
+
+8. Benchmark
+------------
+
+With --benchmark, the performance of the tests is measured and reported as benchmark_*
+properties in the xunit file and after the final report:
+
+  * Seeks: number of seeks, p50, p95 and maximum time (in milliseconds) between sending
+    a seek and the pipeline being prerolled again (ASYNC_DONE), and number of seeks
+    completed per second (for example when scrubbing).
+  * Startup: time (in milliseconds) from spawning the process to gst-validate being
+    initialized, to the pipeline reaching PAUSED and PLAYING, and to the first known
+    position (positions are queried every 250ms). The median time to PLAYING and to the
+    first position are also summed up in a table with a row per media and a column per
+    protocol (and network profile), the same for each run so runs can be compared.
+  * Throughput: for the tests rendering a file (transcoding, GES rendering), the real-time
+    factor (media seconds processed per wall second) and the output bytes written per
+    second, both over the whole run of the test (from spawning it to its exit), summed
+    up in tables with a row per source media and a column per container/codecs
+    combination.
+
+The figures of a run can be saved with --save-benchmark-baseline FILE, and later runs
+given --benchmark-baseline FILE fail the tests whose throughput dropped by more than
+--benchmark-tolerance percents (10 by default):
+
+    $ gst-validate-launcher --save-benchmark-baseline baseline.json -t transcode
+    $ gst-validate-launcher --benchmark-baseline baseline.json -t transcode
+
+Running several tests at once (-j) makes those figures less reliable.
 ''' % ("\n  * ".join([reporter.name for reporter in
                       utils.get_subclasses(reporters.Reporter, reporters.__dict__)]
                      ),
@@ -132,6 +214,19 @@ QA_ASSETS = "gst-qa-assets"
 MEDIAS_FOLDER = "medias"
 DEFAULT_GST_QA_ASSETS_REPO = "git://people.freedesktop.org/~tsaunier/gst-qa-assets/"
 
+def shard(value):
+    try:
+        index, count = [int(v) for v in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not of the form INDEX/COUNT"
+                                         % value)
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("Shard index %d is not between 1 and %d"
+                                         % (index, count))
+
+    return (index, count)
+
 class Formatter(argparse.RawDescriptionHelpFormatter):
     def _format_usage(self, usage, actions, groups, prefix):
         pass
@@ -155,9 +250,50 @@ def main():
     parser.add_argument("-f", "--forever", dest="forever",
                       action="store_true", default=False,
                       help="Keep running tests until one fails")
+    parser.add_argument("--max-rss-growth", dest="max_rss_growth",
+                      default=None, type=float, metavar="BYTES",
+                      help="Fail the tests whose memory usage keeps growing by more than"
+                           " BYTES bytes per second once started. The growth of the"
+                           " memory, file descriptors and threads of the tests is"
+                           " reported when this is set and in --forever mode")
+    parser.add_argument("--max-rss-growth-per-iteration", dest="max_rss_growth_per_iteration",
+                      default=None, type=float, metavar="BYTES",
+                      help="In --forever mode, fail the tests whose maximum memory usage"
+                           " grows by more than BYTES bytes per iteration")
     parser.add_argument("-F", "--fatal-error", dest="fatal_error",
                       action="store_true", default=False,
                       help="Stop on first fail")
+    parser.add_argument("-j", "--jobs", dest="num_jobs",
+                      default=1, type=int,
+                      help="Number of tests (and media info discoverers) to run in parallel")
+    parser.add_argument("--timeout-check-interval", dest="timeout_check_interval",
+                      default=1.0, type=float,
+                      help="Interval (in seconds) at which running tests are checked"
+                           " for timeouts. Tests exiting are detected right away.")
+    parser.add_argument("--shard", dest="shard", metavar="INDEX/COUNT",
+                      default=None, type=shard,
+                      help="Split the tests in COUNT shards of about the same"
+                           " duration and only run the INDEX-th one (starting from 1)")
+    parser.add_argument("--benchmark", dest="benchmark",
+                      action="store_true", default=False,
+                      help="Measure the performance of the tests (for example the"
+                           " latency of the seeks), reporting it in the xunit"
+                           " file and after the final report. Results are not"
+                           " taken from the cache")
+    parser.add_argument("--benchmark-baseline", dest="benchmark_baseline_file",
+                      default=None, metavar="FILE",
+                      help="Fail the tests whose throughput dropped compared to the"
+                           " baseline saved in FILE with --save-benchmark-baseline"
+                           " (implies --benchmark)")
+    parser.add_argument("--benchmark-tolerance", dest="benchmark_tolerance",
+                      default=10.0, type=float, metavar="PERCENT",
+                      help="Drop of the throughput (in percents) tolerated when"
+                           " comparing to --benchmark-baseline")
+    parser.add_argument("--save-benchmark-baseline", dest="save_benchmark_baseline",
+                      default=None, metavar="FILE",
+                      help="Save the benchmark figures of the tests that passed to"
+                           " FILE, replacing the ones of the same tests"
+                           " (implies --benchmark)")
     parser.add_argument("-t", "--wanted-tests", dest="wanted_tests",
                       default=[],
                       action="append",
@@ -168,6 +304,20 @@ def main():
                       default=[],
                       action="append",
                       help="Define the tests not to execute, it can be a regex.")
+    parser.add_argument("--rerun-failed", dest="rerun_failed", metavar="XUNIT_FILE",
+                      default=None,
+                      help="Only run the tests that failed or timed out in the"
+                           " given xunit report of a previous run")
+    parser.add_argument("--retry-failed", dest="retry_failed",
+                      default=0, type=int, metavar="N",
+                      help="Run the tests that fail or time out up to N more times,"
+                           " reporting the ones that end up passing as flaky. Tests"
+                           " that failed every attempt in their last %d runs are not"
+                           " retried until they pass again" % RETRY_MAX_FAILED_RUNS)
+    parser.add_argument("--resume", dest="resume",
+                      action="store_true", default=False,
+                      help="Resume the interrupted run that used the same LOGSDIR,"
+                           " only running the tests that did not finish")
     parser.add_argument("-L", "--list-tests",
                       dest="list_tests",
                       action="store_true",
@@ -192,6 +342,11 @@ def main():
                       default=None,
                       help=("Path to xml file to store the xunit report in. "
                       "Default is LOGSDIR/xunit.xml"))
+    parser.add_argument('--merge-xunit', action='append',
+                      dest='merge_xunit', metavar="FILE",
+                      default=[],
+                      help=("Merge the given xunit report (for example from "
+                      "another --shard) into the --xunit-file and exit"))
     dir_group.add_argument("-M", "--main-dir", dest="main_dir",
                       default=DEFAULT_MAIN_DIR,
                          help="Main directory where to put files. Default is %s" % DEFAULT_MAIN_DIR)
@@ -211,13 +366,44 @@ def main():
                       default=None,
                       help="Paths in which to look for media files, default is MAIN_DIR/gst-qa-assets")
 
+    cache_group = parser.add_argument_group("Handle the cache of test results")
+    cache_group.add_argument("--cache", dest="use_cache",
+                      default=False, action='store_true',
+                      help="Do not run the tests whose result is in the cache, and"
+                           " cache the results of the tests that pass")
+    cache_group.add_argument("--cache-plugins", dest="cache_plugins",
+                      default=[], action='append', metavar="PATTERN",
+                      help="Files (for example GStreamer plugins) the cached results"
+                           " of all tests depend on, as shell patterns (can be used"
+                           " several times). Defaults to all the GStreamer plugins")
+    cache_group.add_argument("--cache-max-age", dest="cache_max_age",
+                      default=30, type=float, metavar="DAYS",
+                      help="Remove the results cached more than DAYS days ago")
+    cache_group.add_argument("--cache-max-size", dest="cache_max_size",
+                      default=1024, type=int, metavar="MB",
+                      help="Remove the oldest cached results when their logs take"
+                           " more than MB megabytes")
+
     http_server_group = parser.add_argument_group("Handle the HTTP server to be created")
     http_server_group.add_argument("--http-server-port", dest="http_server_port",
-                      default=8079,
-                      help="Port on which to run the http server on localhost")
+                      default=utils.DEFAULT_HTTP_SERVER_PORT, type=int,
+                      help="Port on which to run the http server on localhost,"
+                           " 0 to let the system choose one (implies"
+                           " --in-process-http-server)")
+    http_server_group.add_argument("--in-process-http-server",
+                      dest="http_server_in_process",
+                      default=False, action='store_true',
+                      help="Run the http server in a thread of the launcher"
+                           " instead of a separate process")
     http_server_group.add_argument("-s", "--folder-for-http-server", dest="http_server_dir",
                       default=None,
                       help="Folder in which to create an http server on localhost. Default is PATHS")
+    http_server_group.add_argument("--network-profile", dest="network_profiles",
+                      default=[], action='append',
+                      choices=sorted(RangeHTTPServer.NETWORK_PROFILES.keys()),
+                      help="Also run the playback tests of the media served by the"
+                           " http server under the given emulated network conditions"
+                           " (can be used several times)")
     http_server_group.add_argument("--http-only", dest="httponly",
                       default=False, action='store_true',
                       help="Start the http server and quit")
@@ -238,7 +424,8 @@ def main():
     assets_group.add_argument("--usage", dest="sync", action=PrintUsage,
                             help="Print usage documentation")
 
-    loggable.init("GST_VALIDATE_LAUNCHER_DEBUG", True, False)
+    loggable.init("GST_VALIDATE_LAUNCHER_DEBUG", True, False,
+                  asyncOutput=bool(os.environ.get("GST_VALIDATE_LAUNCHER_DEBUG_ASYNC")))
 
     tests_launcher = _TestsLauncher()
     tests_launcher.add_options(parser)
@@ -262,6 +449,31 @@ def main():
     if options.dest is None:
         options.dest = os.path.join(options.output_dir, "rendered")
 
+    if options.merge_xunit:
+        utils.mkdir(os.path.dirname(os.path.abspath(options.xunit_file)))
+        reporters.merge_xunit_files(options.merge_xunit, options.xunit_file)
+        printc("Merged %d reports into %s" % (len(options.merge_xunit),
+                                             options.xunit_file), Colors.OKGREEN)
+        return 0
+
+    options.rerun_tests = None
+    if options.rerun_failed:
+        options.rerun_tests = set(reporters.get_failed_tests(options.rerun_failed))
+        printc("Rerunning the %d tests that failed in %s"
+               % (len(options.rerun_tests), options.rerun_failed), Colors.OKBLUE)
+
+    options.benchmark_baseline = None
+    if options.benchmark_baseline_file:
+        try:
+            with open(options.benchmark_baseline_file) as f:
+                options.benchmark_baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            printc("Could not read the benchmark baseline %s: %s"
+                   % (options.benchmark_baseline_file, e), Colors.FAIL, True)
+            return -1
+    if options.benchmark_baseline is not None or options.save_benchmark_baseline:
+        options.benchmark = True
+
     if not os.path.exists(options.dest):
         os.makedirs(options.dest)
     if urlparse.urlparse(options.dest).scheme == "":
@@ -310,6 +522,14 @@ def main():
 
     # Ensure that the scenario manager singleton is ready to be used
     ScenarioManager().config = options
+
+    httpsrv = HTTPServer(options)
+    # The uris of the tests contain the port of the server
+    if not options.http_server_port and not options.httponly:
+        if not httpsrv.bind():
+            printc("Could not bind the http server", Colors.FAIL, True)
+            return -1
+
     tests_launcher.list_tests()
 
     if options.list_tests:
@@ -319,14 +539,21 @@ def main():
             printc(test)
 
         printc("\nNumber of tests: %d" % len (l), Colors.OKGREEN)
+        httpsrv.stop()
         return 0
 
-    httpsrv = HTTPServer(options)
     if tests_launcher.needs_http_server() or options.httponly is True:
         httpsrv.start()
+    else:
+        # Do not keep the port chosen for the listing of the tests
+        httpsrv.stop()
 
     if options.httponly is True:
         print "Running HTTP server only"
+        # The server dies with the launcher when running in it, which is
+        # also the case when the system chooses the port
+        if httpsrv.is_in_process():
+            httpsrv.wait()
         return
 
     e = None
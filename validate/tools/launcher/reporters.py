@@ -22,9 +22,12 @@
 import os
 import re
 import codecs
+import shutil
+import tempfile
 from loggable import Loggable
 from xml.sax import saxutils
-from utils import mkdir, Result, printc, Colors
+from xml.etree import cElementTree
+from utils import mkdir, Result, printc, Colors, LOG_CHUNK_SIZE
 
 UNICODE_STRINGS = (type(unicode()) == type(str()))
 
@@ -52,8 +55,6 @@ class Reporter(Loggable):
     def __init__(self, options):
         Loggable.__init__(self)
 
-        self._current_test = None
-        self.out = None
         self.options = options
         self.stats = {'timeout': 0,
                       'failures': 0,
@@ -67,8 +68,7 @@ class Reporter(Loggable):
         path = os.path.join(self.options.logsdir,
                             test.classname.replace(".", os.sep))
         mkdir(os.path.dirname(path))
-        self.out = open(path, 'w+')
-        self._current_test = test
+        test.out = open(path, 'w+')
         test.logfile = path
 
     def set_failed(self, test):
@@ -87,12 +87,17 @@ class Reporter(Loggable):
         else:
             raise UnknownResult("%s" % test.result)
 
-    def after_test(self):
-        self.results.append(self._current_test)
-        self.add_results(self._current_test)
-        self.out.close()
-        self.out = None
-        self._current_test = None
+    def after_test(self, test):
+        self.results.append(test)
+        self.add_results(test)
+        test.out.close()
+        test.out = None
+
+    def discard_test(self, test):
+        """Forget about a test that ran but should not be reported."""
+        if test.out:
+            test.out.close()
+            test.out = None
 
     def final_report(self):
         print "\n"
@@ -125,29 +130,55 @@ class XunitReporter(Reporter):
 
     def __init__(self, options):
         super(XunitReporter, self).__init__(options)
-        self.errorlist = []
+        # The testcases are written there as tests finish, and copied to the
+        # xunit file after its header once the totals are known
+        self._testcases = tempfile.TemporaryFile()
 
     def final_report(self):
         self.report()
         super(XunitReporter, self).final_report()
 
-    def _get_captured(self):
-        captured = ""
-        if self.out:
-            self.out.seek(0)
-            value = self.out.read()
-            if value:
-                captured += '<system-out><![CDATA[%s' % \
-                    escape_cdata(value)
+    def _write(self, string):
+        self._testcases.write(self._forceUnicode(string).encode(self.encoding))
+
+    def _write_cdata(self, chunks):
+        """Writes @chunks, read from a log file, as CDATA."""
+        decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+        pending = u''
+        for chunk in chunks:
+            pending += decoder.decode(chunk)
+            # Keep the trailing ']' for the next chunk so that a ']]>'
+            # split between two chunks is escaped
+            cut = len(pending.rstrip(u']'))
+            self._write(escape_cdata(pending[:cut]))
+            pending = pending[cut:]
+
+        self._write(escape_cdata(pending + decoder.decode('', True)))
+
+    def _write_captured(self, test):
+        if not test.out:
+            return
+
+        self._write('<system-out><![CDATA[')
+        test.out.seek(0)
+        self._write_cdata(iter(lambda: test.out.read(LOG_CHUNK_SIZE), ''))
+
+        for extralog in test.extra_logfiles:
+            self._write("\n\n===== %s =====\n\n" %
+                        escape_cdata(os.path.basename(extralog)))
+            self._write_cdata(test.iter_extra_log_content(extralog))
 
-            for extralog in self._current_test.extra_logfiles:
-                captured += "\n\n===== %s =====\n\n" % escape_cdata(os.path.basename(extralog))
-                value = self._current_test.get_extra_log_content(extralog)
-                captured += escape_cdata(value)
+        self._write(']]></system-out>')
 
-            captured += "]]></system-out>"
+    def _write_properties(self, test):
+        if not test.properties:
+            return
 
-        return captured
+        self._write('<properties>')
+        for name, value in sorted(test.properties.items()):
+            self._write('<property name=%s value=%s/>' %
+                        (self._quoteattr(name), self._quoteattr(str(value))))
+        self._write('</properties>')
 
     def _quoteattr(self, attr):
         """Escape an XML attribute. Value can be unicode."""
@@ -163,51 +194,110 @@ class XunitReporter(Reporter):
 
         """
         self.debug("Writing XML file to: %s", self.options.xunit_file)
-        self.xml_file = codecs.open(self.options.xunit_file, 'w',
-                                    self.encoding, 'replace')
+        self.xml_file = open(self.options.xunit_file, 'w')
         self.stats['encoding'] = self.encoding
         self.stats['total'] = (self.stats['timeout'] + self.stats['failures']
                                + self.stats['passed'] + self.stats['skipped'])
-        self.xml_file.write( u'<?xml version="1.0" encoding="%(encoding)s"?>'
+        self.xml_file.write((u'<?xml version="1.0" encoding="%(encoding)s"?>'
             u'<testsuite name="gst-validate-launcher" tests="%(total)d" '
             u'errors="%(timeout)d" failures="%(failures)d" '
-            u'skip="%(skipped)d">' % self.stats)
-        self.xml_file.write(u''.join([self._forceUnicode(e)
-                            for e in self.errorlist]))
-        self.xml_file.write(u'</testsuite>')
+            u'skip="%(skipped)d">' % self.stats).encode(self.encoding))
+        self._testcases.seek(0)
+        shutil.copyfileobj(self._testcases, self.xml_file, LOG_CHUNK_SIZE)
+        self._testcases.seek(0, os.SEEK_END)
+        self.xml_file.write(u'</testsuite>'.encode(self.encoding))
         self.xml_file.close()
 
     def set_failed(self, test):
         """Add failure output to Xunit report.
         """
         self.stats['failures'] += 1
-        self.errorlist.append(
-            '<testcase classname=%(cls)s name=%(name)s time="%(taken).3f">'
-            '<failure type=%(errtype)s message=%(message)s>'
-            '</failure>%(systemout)s</testcase>' %
+        self._write(
+            '<testcase classname=%(cls)s name=%(name)s time="%(taken).3f">' %
             {'cls': self._quoteattr(test.get_classname()),
              'name': self._quoteattr(test.get_name()),
              'taken': test.time_taken,
-             'errtype': self._quoteattr(test.result),
+             })
+        self._write_properties(test)
+        self._write(
+            '<failure type=%(errtype)s message=%(message)s>'
+            '</failure>' %
+            {'errtype': self._quoteattr(test.result),
              'message': self._quoteattr(test.message),
-             'systemout': self._get_captured(),
              })
+        self._write_captured(test)
+        self._write('</testcase>')
 
     def set_passed(self, test):
         """Add success output to Xunit report.
         """
         self.stats['passed'] += 1
-        self.errorlist.append(
+        self._write(
             '<testcase classname=%(cls)s name=%(name)s '
-            'time="%(taken).3f">%(systemout)s</testcase>' %
+            'time="%(taken).3f">' %
             {'cls': self._quoteattr(test.get_classname()),
              'name': self._quoteattr(test.get_name()),
              'taken': test.time_taken,
-             'systemout': self._get_captured(),
              })
+        self._write_properties(test)
+        self._write_captured(test)
+        self._write('</testcase>')
 
     def _forceUnicode(self, s):
         if not UNICODE_STRINGS:
             if isinstance(s, str):
                 s = s.decode(self.encoding, 'replace')
         return s
+
+
+def get_failed_tests(path):
+    """
+    Returns: The names of the tests that failed or timed out in the xunit
+             file at @path
+    """
+    tests = []
+    # The reports contain the logs of the tests, do not keep them around
+    for event, element in cElementTree.iterparse(path):
+        if element.tag == "testcase":
+            if element.find("failure") is not None or \
+                    element.find("error") is not None:
+                tests.append("%s.%s" % (element.get("classname"),
+                                        element.get("name")))
+            element.clear()
+
+    return tests
+
+
+def merge_xunit_files(paths, output):
+    """
+    Merges the xunit files generated by XunitReporter in several runs (for
+    example one per --shard) into @output.
+
+    The reports contain the logs of the tests, so the testcases are
+    streamed from one file to the other instead of being loaded at once.
+    """
+    counters = ["tests", "errors", "failures", "skip"]
+    totals = dict((counter, 0) for counter in counters)
+    for path in paths:
+        for event, testsuite in cElementTree.iterparse(path, events=("start", )):
+            for counter in counters:
+                totals[counter] += int(testsuite.get(counter, 0))
+            break
+
+    with open(output, 'w') as f:
+        f.write((u'<?xml version="1.0" encoding="%s"?>'
+                 u'<testsuite name="gst-validate-launcher" tests="%d" '
+                 u'errors="%d" failures="%d" skip="%d">'
+                 % (XunitReporter.encoding, totals["tests"], totals["errors"],
+                    totals["failures"], totals["skip"])).encode(XunitReporter.encoding))
+        for path in paths:
+            testsuite = None
+            for event, element in cElementTree.iterparse(path, events=("start", "end")):
+                if testsuite is None:
+                    testsuite = element
+                elif event == "end" and element.tag == "testcase":
+                    element.tail = None
+                    f.write(cElementTree.tostring(element, encoding="utf-8"))
+                    # Do not keep the testcases around once written
+                    testsuite.clear()
+        f.write(u'</testsuite>'.encode(XunitReporter.encoding))
@@ -21,6 +21,7 @@
 import sys
 import os
 import re
+import math
 import urllib
 import loggable
 import urlparse
@@ -33,10 +34,14 @@ GST_SECOND = long(1000000000)
 DEFAULT_TIMEOUT = 30
 DEFAULT_MAIN_DIR = os.path.expanduser("~/gst-validate/")
 DEFAULT_GST_QA_ASSETS =  os.path.join(DEFAULT_MAIN_DIR, "gst-qa-assets")
+# Port of our http server the stream_info files of the assets point to
+DEFAULT_HTTP_SERVER_PORT = 8079
 DISCOVERER_COMMAND = "gst-discoverer-1.0"
 DURATION_TOLERANCE = GST_SECOND / 2
 # Use to set the duration from which a test is concidered as being 'long'
 LONG_TEST = 40
+# Size of the chunks in which log files are read
+LOG_CHUNK_SIZE = 64 * 1024
 
 class Result(object):
     NOT_RUN = "Not run"
@@ -136,7 +141,8 @@ def path2url(path):
 
 
 def url2path(url):
-    path = urlparse.urlparse(url).path
+    # path2url quotes the path
+    path = urllib.unquote(urlparse.urlparse(url).path)
     if "win32" in sys.platform:
         if path[0] == '/':
             return path[1:] # We need to remove the first '/' on windows
@@ -154,6 +160,29 @@ def touch(fname, times=None):
     with open(fname, 'a'):
         os.utime(fname, times)
 
+def get_slope(points):
+    """
+    Returns: The slope of the least squares line fitting @points, a list of
+             (x, y) tuples, or None if it can not be computed
+    """
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, y in points) / float(len(points))
+    mean_y = sum(y for x, y in points) / float(len(points))
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    if not variance:
+        return None
+
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+def get_percentile(values, percent):
+    """ Returns: The @percent percentile of @values (nearest rank) """
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+
+    return values[max(rank, 1) - 1]
+
 def get_subclasses(klass, env):
     subclasses = []
     for symb in env.iteritems():